@@ -8,8 +8,32 @@
 ##  Testing:
 ##    $ dtree.py -k prop -f out.tree input.feats
 ##
+##  Caching parsed entries:
+##    $ dtree.py -k prop -c input.cache input.feats > out.tree
+##
+##  Prediction:
+##    $ dtree.py -k prop -f out.tree -p input.feats > out.keys
+##
+##  Training a random forest of 100 trees with 4 processes:
+##    $ dtree.py -k prop -F 100 -j 4 input.feats > out.forest
+##
+import os
 import sys
-from math import log2
+import copy
+import mmap
+import random
+import time
+import struct
+import marshal
+from math import log2, sqrt
+from bisect import bisect_right
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # calcetp: calculates an entropy.
@@ -57,6 +81,54 @@ def argmax(keys):
 def entetp(ents, keyprop):
     return calcetp(countkeys( e[keyprop] for e in ents ).values())
 
+##  KeyHistogram
+##  The keys of a node's entries and their counts.
+##  It is computed once per node and shared by all features.
+##
+class KeyHistogram:
+
+    def __init__(self, ents, keyprop):
+        self.keys = [ e[keyprop] for e in ents ]
+        self.counts = countkeys(self.keys)
+        return
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return ('<KeyHistogram: %r>' % self.counts)
+
+    # etp: the entropy of the keys.
+    def etp(self):
+        return calcetp(self.counts.values())
+
+    # best: the most frequent key.
+    def best(self):
+        return argmax(self.counts)
+
+# colsum: computes sum(v*log2(n/v)) for each row of count arrays.
+#   The results are approximate; candidates within EPSILON of the minimum
+#   are recomputed with calcetp() to choose the same split as split().
+EPSILON = 1e-9
+def colsum(counts):
+    n = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(0 < counts, counts*np.log2(n/counts), 0.0)
+    return t.sum(axis=-1)
+
+# colcounts: counts key codes in the order of their first appearance.
+#   calcetp(colcounts(kcodes)) gives exactly the same value as entetp().
+def colcounts(kcodes):
+    (_, first, counts) = np.unique(
+        kcodes, return_index=True, return_counts=True)
+    return counts[np.argsort(first)].tolist()
+
+# colargmax: chooses the most frequent key code of given rows.
+#   Ties are broken by the first appearance like argmax().
+def colargmax(kcodes):
+    (ks, first, counts) = np.unique(
+        kcodes, return_index=True, return_counts=True)
+    return ks[np.lexsort((first, -counts))[0]]
 
 ##  Feature
 ##  Abstract class for features.
@@ -79,10 +151,27 @@ class Feature:
 
     # ident: identify an entry for this feature.
     def ident(self, arg, e):
+        return self.match(arg, self._get(e))
+
+    # match: identify a value returned by _get().
+    def match(self, arg, v):
         raise NotImplementedError
 
+    # presort: returns the entries sorted for this feature, or None.
+    def presort(self, ents):
+        return None
+
     # split: split entries into multiple lists.
-    def split(self, ents, keyprop):
+    #   hist is the KeyHistogram of the entries if given.
+    def split(self, ents, keyprop, hist=None):
+        raise NotImplementedError
+
+    # encode: returns a NumPy column for this feature, or None.
+    def encode(self, ents):
+        return None
+
+    # colsplit: split rows of a ColumnSet into multiple arrays.
+    def colsplit(self, cs, rows):
         raise NotImplementedError
 
 ##  DiscreteFeature
@@ -93,22 +182,53 @@ class DiscreteFeature(Feature):
         Feature.__init__(self, prefix+attr, attr)
         return
 
-    def ident(self, arg, e):
-        return self._get(e)
+    def match(self, arg, v):
+        return v
 
-    def split(self, ents, keyprop):
+    def split(self, ents, keyprop, hist=None):
         assert 2 <= len(ents)
+        if hist is None:
+            hist = KeyHistogram(ents, keyprop)
+        # Count the keys for each value while grouping entries.
         d = {}
-        for e in ents:
+        for (e,k) in zip(ents, hist.keys):
             v = self._get(e)
             if v in d:
-                d[v].append(e)
+                (es, keys) = d[v]
             else:
-                d[v] = [e]
+                (es, keys) = d[v] = ([], {})
+            es.append(e)
+            keys[k] = keys.get(k, 0) + 1
         if len(d) < 2: raise self.InvalidSplit
         n = len(ents)
-        avgetp = sum( len(es) * entetp(es, keyprop) for es in d.values() ) / n
-        split = list(d.items())
+        avgetp = sum( len(es) * calcetp(keys.values())
+                      for (es,keys) in d.values() ) / n
+        split = [ (v, es) for (v,(es,_)) in d.items() ]
+        return (avgetp, None, split)
+
+    def encode(self, ents):
+        index = {}
+        codes = []
+        for e in ents:
+            v = self._get(e)
+            if v not in index:
+                index[v] = len(index)
+            codes.append(index[v])
+        return (np.array(codes, dtype=np.intp), list(index.keys()))
+
+    def colsplit(self, cs, rows):
+        assert 2 <= len(rows)
+        (codes, values) = cs.cols[self.name]
+        (vs, first, inv, sizes) = np.unique(
+            codes[rows], return_index=True, return_inverse=True,
+            return_counts=True)
+        if len(vs) < 2: raise self.InvalidSplit
+        # Groups are ordered by their first appearance.
+        groups = np.split(rows[np.argsort(inv, kind='stable')],
+                          np.cumsum(sizes)[:-1])
+        split = [ (values[vs[j]], groups[j]) for j in np.argsort(first) ]
+        avgetp = sum( len(a) * calcetp(colcounts(cs.kcodes[a]))
+                      for (_,a) in split ) / len(rows)
         return (avgetp, None, split)
 
 DF = DiscreteFeature
@@ -144,34 +264,102 @@ class MembershipFeature(Feature):
         if v is None: return []
         return v.split(',')
 
-    def ident(self, arg, e):
-        return arg in self._get(e)
+    def match(self, arg, v):
+        return arg in v
 
-    def split(self, ents, keyprop):
+    def split(self, ents, keyprop, hist=None):
         assert 2 <= len(ents)
+        if hist is None:
+            hist = KeyHistogram(ents, keyprop)
+        # Count the keys for each value in one pass.
+        total = hist.counts
         d = {}
-        for e in ents:
-            for v in self._get(e):
+        for (e,k) in zip(ents, hist.keys):
+            for v in dict.fromkeys(self._get(e)):
                 if v in d:
-                    es = d[v]
+                    keys = d[v]
                 else:
-                    es = d[v] = set()
-                es.add(e)
+                    keys = d[v] = {}
+                keys[k] = keys.get(k, 0) + 1
         if len(d) < 2: raise self.InvalidSplit
         n = len(ents)
-        minsplit = minetp = None
-        for (v,es) in d.items():
-            nes = [ e for e in ents if e not in es ]
-            if not nes: continue
-            avgetp = (len(es)*entetp(es, keyprop) +
-                      len(nes)*entetp(nes, keyprop)) / n
-            if minsplit is None or avgetp < minetp:
+        # The counts are sorted so that the entropy does not depend on
+        # the order of the keys and equal candidates tie exactly.
+        minarg = minetp = None
+        for (v,keys) in d.items():
+            m = sum(keys.values())
+            if m == n: continue
+            # The counts of the complement is derived from the total.
+            nkeys = [ c-keys.get(k,0) for (k,c) in total.items()
+                      if c != keys.get(k,0) ]
+            avgetp = (m*calcetp(sorted(keys.values())) +
+                      (n-m)*calcetp(sorted(nkeys))) / n
+            if minarg is None or avgetp < minetp:
                 minetp = avgetp
-                minsplit = (v, nes)
-        if minsplit is None: raise self.InvalidSplit
-        (arg, nes) = minsplit
-        split = [(True, list(d[arg])), (False, nes)]
-        return (minetp, arg, split)
+                minarg = v
+        if minarg is None: raise self.InvalidSplit
+        es = []
+        nes = []
+        for e in ents:
+            if minarg in self._get(e):
+                es.append(e)
+            else:
+                nes.append(e)
+        split = [(True, es), (False, nes)]
+        return (minetp, minarg, split)
+
+    def encode(self, ents):
+        index = {}
+        ptrs = [0]
+        codes = []
+        for e in ents:
+            for v in dict.fromkeys(self._get(e)):
+                if v not in index:
+                    index[v] = len(index)
+                codes.append(index[v])
+            ptrs.append(len(codes))
+        return (np.array(ptrs, dtype=np.intp),
+                np.array(codes, dtype=np.intp), list(index.keys()))
+
+    def colsplit(self, cs, rows):
+        assert 2 <= len(rows)
+        (ptrs, codes, values) = cs.cols[self.name]
+        # Gather the members of the rows in order.
+        starts = ptrs[rows]
+        lens = ptrs[rows+1] - starts
+        pos = np.repeat(np.arange(len(rows)), lens)
+        members = codes[np.repeat(starts-np.cumsum(lens)+lens, lens) +
+                        np.arange(lens.sum())]
+        (vs, first, inv) = np.unique(
+            members, return_index=True, return_inverse=True)
+        if len(vs) < 2: raise self.InvalidSplit
+        # The counts of the complement is derived from the total.
+        kcodes = cs.kcodes[rows]
+        n = len(rows)
+        incounts = np.bincount(
+            inv*cs.nkeys + kcodes[pos],
+            minlength=len(vs)*cs.nkeys).reshape(len(vs), cs.nkeys)
+        outcounts = np.bincount(kcodes, minlength=cs.nkeys) - incounts
+        avgetp = (colsum(incounts) + colsum(outcounts)) / n
+        order = np.argsort(first)
+        order = order[0 < outcounts[order].sum(axis=1)]
+        if len(order) == 0: raise self.InvalidSplit
+        # The closest candidates are recomputed from their sorted counts
+        # to choose the same split as split().
+        minj = minetp = None
+        for j in order[avgetp[order] <= avgetp[order].min()+EPSILON]:
+            ins = incounts[j][0 < incounts[j]].tolist()
+            outs = outcounts[j][0 < outcounts[j]].tolist()
+            etp = (sum(ins)*calcetp(sorted(ins)) +
+                   sum(outs)*calcetp(sorted(outs))) / n
+            if minj is None or etp < minetp:
+                minetp = etp
+                minj = j
+        j = minj
+        mask = np.zeros(n, dtype=bool)
+        mask[pos[inv == j]] = True
+        split = [(True, rows[mask]), (False, rows[~mask])]
+        return (minetp, values[vs[j]], split)
 
 MF = MembershipFeature
 
@@ -197,10 +385,29 @@ class QuantitativeFeature(Feature):
 
     def __init__(self, attr, prefix='QF:'):
         Feature.__init__(self, prefix+attr, attr)
+        self.edges = None
+        self.exactkeys = 0
         return
 
-    def ident(self, arg, e):
-        v = self._get(e)
+    # setbins: divides the values into nbins quantiles so that
+    #   only the boundaries of the bins are evaluated in split().
+    #   Nodes with fewer than exactkeys entries are split exactly.
+    def setbins(self, ents, nbins, exactkeys=0):
+        vs = [ v for (_,v) in self.presort(ents) ]
+        if nbins < 2 or not vs:
+            self.edges = None
+        else:
+            n = len(vs)
+            self.edges = sorted(set( vs[n*j//nbins] for j in range(1, nbins) ))
+        self.exactkeys = exactkeys
+        return
+
+    # _binned: returns the bin edges to use for n entries, or None.
+    def _binned(self, n):
+        if self.edges is None or n < self.exactkeys: return None
+        return self.edges
+
+    def match(self, arg, v):
         if v is None:
             return 'un'
         elif v < arg:
@@ -208,29 +415,69 @@ class QuantitativeFeature(Feature):
         else:
             return 'ge'
 
-    def split(self, ents, keyprop):
-        assert 2 <= len(ents)
+    # presort: returns (entry, value) pairs sorted by the value.
+    def presort(self, ents):
         pairs = []
-        undefs = []
         for e in ents:
             v = self._get(e)
-            if v is None:
-                undefs.append(e)
-            else:
+            if v is not None:
                 pairs.append((e, v))
-        if not pairs: raise self.InvalidSplit
         pairs.sort(key=(lambda ev: ev[1]))
+        return pairs
+
+    def split(self, ents, keyprop, presorted=None, hist=None):
+        assert 2 <= len(ents)
+        if presorted is None:
+            pairs = self.presort(ents)
+        else:
+            pairs = presorted
+        if not pairs: raise self.InvalidSplit
+        undefs = []
+        if len(pairs) < len(ents):
+            undefs = [ e for e in ents if self._get(e) is None ]
         es = [ e for (e,_) in pairs ]
         vs = [ v for (_,v) in pairs ]
+        ks = [ e[keyprop] for e in es ]
         n = len(pairs)
+        # first[k]: the first position of key k in es[i:].
+        # nxt[j]: the next position of the key ks[j] after j.
+        first = {}
+        nxt = [n]*n
+        for j in range(n-1, -1, -1):
+            k = ks[j]
+            nxt[j] = first.get(k, n)
+            first[k] = j
+        # Sweep the thresholds with the key counts of both sides.
+        # The counts are kept in the order countkeys() would give
+        # so that the entropies are computed exactly the same way.
+        left = {}
+        if hist is not None and n == len(hist):
+            right = hist.counts.copy()
+        else:
+            right = countkeys(ks)
         minsplit = minetp = None
         v0 = vs[0]
+        edges = self._binned(len(ents))
+        if edges is not None:
+            b0 = bisect_right(edges, v0)
         for i in range(1, n):
+            k = ks[i-1]
+            left[k] = left.get(k, 0) + 1
+            right[k] -= 1
+            if right[k] == 0:
+                del right[k]
+            first[k] = nxt[i-1]
             v1 = vs[i]
             if v0 == v1: continue
             v0 = v1
-            avgetp = (i * entetp(es[:i], keyprop) +
-                      (n-i) * entetp(es[i:], keyprop)) / n
+            if edges is not None:
+                # Only the boundaries of bins are evaluated.
+                b1 = bisect_right(edges, v1)
+                if b0 == b1: continue
+                b0 = b1
+            rvalues = [ right[k] for k in sorted(right, key=first.get) ]
+            avgetp = (i * calcetp(left.values()) +
+                      (n-i) * calcetp(rvalues)) / n
             if minsplit is None or avgetp < minetp:
                 minetp = avgetp
                 minsplit = i
@@ -241,8 +488,74 @@ class QuantitativeFeature(Feature):
             split.append(('un', undefs))
         return (minetp, arg, split)
 
+    def encode(self, ents):
+        values = []
+        for e in ents:
+            v = self._get(e)
+            if v is None:
+                values.append(np.nan)
+            elif isinstance(v, (int, float)):
+                values.append(v)
+            else:
+                return None
+        return np.array(values, dtype=np.float64)
+
+    def colsplit(self, cs, rows):
+        assert 2 <= len(rows)
+        values = cs.cols[self.name][rows]
+        defined = ~np.isnan(values)
+        values = values[defined]
+        if len(values) == 0: raise self.InvalidSplit
+        order = np.argsort(values, kind='stable')
+        srows = rows[defined][order]
+        values = values[order]
+        n = len(srows)
+        # Candidate thresholds are the boundaries of distinct values.
+        edges = self._binned(len(rows))
+        if edges is not None:
+            bins = np.searchsorted(edges, values, side='right')
+            cands = np.nonzero(bins[1:] != bins[:-1])[0] + 1
+        else:
+            cands = np.nonzero(values[1:] != values[:-1])[0] + 1
+        if len(cands) == 0: raise self.InvalidSplit
+        kcodes = cs.kcodes[srows]
+        left = np.empty((len(cands), cs.nkeys), dtype=np.intp)
+        for k in range(cs.nkeys):
+            left[:,k] = np.cumsum(kcodes == k)[cands-1]
+        right = np.bincount(kcodes, minlength=cs.nkeys) - left
+        avgetp = (colsum(left) + colsum(right)) / n
+        minsplit = minetp = None
+        for i in cands[avgetp <= avgetp.min()+EPSILON]:
+            etp = (i * calcetp(colcounts(kcodes[:i])) +
+                   (n-i) * calcetp(colcounts(kcodes[i:]))) / n
+            if minsplit is None or etp < minetp:
+                minetp = etp
+                minsplit = i
+        i = minsplit
+        arg = self._get(cs.ents[srows[i]])
+        split = [('lt', srows[:i]), ('ge', srows[i:])]
+        if not defined.all():
+            split.append(('un', rows[~defined]))
+        return (minetp, arg, split)
+
 QF = QuantitativeFeature
 
+# partition: distributes presorted (entry, value) pairs into each list
+#   of a split, keeping the order that a stable sort would give.
+def partition(pairs, split, pos):
+    parts = [ [] for _ in split ]
+    for (e,v) in pairs:
+        parts[pos[id(e)][0]].append((e, v))
+    # Equal values must follow the order of the entries in each list.
+    for a in parts:
+        i0 = 0
+        for i in range(1, len(a)+1):
+            if i < len(a) and a[i][1] == a[i0][1]: continue
+            if 1 < i-i0:
+                a[i0:i] = sorted(a[i0:i], key=(lambda ev: pos[id(ev[0])][1]))
+            i0 = i
+    return parts
+
 
 ##  TreeBranch
 ##
@@ -307,16 +620,185 @@ class TreeLeaf:
         return
 
 
+##  CompiledTree
+##  A tree flattened into a table for fast testing.
+##  Each node is (feature index, feature, arg, default, children)
+##  and each feature value is taken only once per entry.
+##
+class CompiledTree:
+
+    def __init__(self, tree):
+        self.feats = []
+        self.nodes = []
+        self._add(tree, {})
+        return
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _add(self, tree, index):
+        i = len(self.nodes)
+        self.nodes.append(None)
+        if isinstance(tree, TreeBranch):
+            feat = tree.feature
+            if feat.name not in index:
+                index[feat.name] = len(self.feats)
+                self.feats.append(feat)
+            children = { v: self._add(branch, index)
+                         for (v,branch) in tree.children.items() }
+            self.nodes[i] = (index[feat.name], feat, tree.arg,
+                             tree.default, children)
+        else:
+            self.nodes[i] = (-1, None, None, tree.key, None)
+        return i
+
+    # predict: returns the same key as TreeBranch.test().
+    def predict(self, e):
+        nodes = self.nodes
+        values = [self] * len(self.feats)
+        parent = None
+        (k, feat, arg, default, children) = nodes[0]
+        while 0 <= k:
+            v = values[k]
+            if v is self:
+                try:
+                    v = values[k] = feat._get(e)
+                except KeyError:
+                    # A missing attribute falls back to the parent.
+                    if parent is None: raise
+                    return parent
+            i = children.get(feat.match(arg, v))
+            if i is None: break
+            parent = default
+            (k, feat, arg, default, children) = nodes[i]
+        return default
+
+    # predict_many: predicts the keys of entries one by one.
+    #   ents can be any iterable; the results are generated lazily.
+    def predict_many(self, ents):
+        for e in ents:
+            yield self.predict(e)
+        return
+
+
+##  TreeProfiler
+##  Records the number of entries of each node and the time and
+##  the number of entropy computations of each split in build().
+##  Entropies are counted while the profiler is used with "with",
+##  and the functions are restored when the block exits, also on errors.
+##
+_ETPFUNCS = (calcetp, colsum)
+class TreeProfiler:
+
+    def __init__(self):
+        self.nodes = []
+        self.netps = 0
+        return
+
+    # __enter__: swaps in the counting wrappers of calcetp() and colsum().
+    #   Only one profiler can count at a time.
+    def __enter__(self):
+        g = globals()
+        if (g['calcetp'], g['colsum']) != _ETPFUNCS:
+            raise RuntimeError('another profiler is active')
+        (calcetp0, colsum0) = _ETPFUNCS
+        def calcetp1(values):
+            self.netps += 1
+            return calcetp0(values)
+        def colsum1(counts):
+            self.netps += len(counts) if counts.ndim == 2 else 1
+            return colsum0(counts)
+        g['calcetp'] = calcetp1
+        g['colsum'] = colsum1
+        return self
+
+    # __exit__: restores the original functions.
+    def __exit__(self, *exc):
+        g = globals()
+        (g['calcetp'], g['colsum']) = _ETPFUNCS
+        return
+
+    # node: starts a new node.
+    def node(self, depth, nents):
+        self.nodes.append({ 'depth': depth, 'ents': nents, 'splits': [] })
+        return
+
+    # split: calls func and records it as a split of feat.
+    def split(self, feat, func, *args, **kwargs):
+        netps = self.netps
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(feat, time.perf_counter()-t0, self.netps-netps)
+
+    # record: records a split of feat at the current node.
+    def record(self, feat, elapsed, netps):
+        self.nodes[-1]['splits'].append(
+            { 'feature': feat.name, 'class': feat.__class__.__name__,
+              'time': elapsed, 'etps': netps })
+        return
+
+    # merge: adds the nodes and entropy count recorded elsewhere.
+    def merge(self, nodes, netps):
+        self.nodes.extend(nodes)
+        self.netps += netps
+        return
+
+    # report: returns the records and the totals for each
+    #   Feature subclass and depth.
+    def report(self):
+        classes = {}
+        depths = {}
+        for node in self.nodes:
+            d = str(node['depth'])
+            if d not in depths:
+                depths[d] = { 'nodes': 0, 'ents': 0, 'time': 0.0, 'etps': 0 }
+            a = depths[d]
+            a['nodes'] += 1
+            a['ents'] += node['ents']
+            for split in node['splits']:
+                a['time'] += split['time']
+                a['etps'] += split['etps']
+                c = split['class']
+                if c not in classes:
+                    classes[c] = { 'splits': 0, 'ents': 0,
+                                   'time': 0.0, 'etps': 0 }
+                b = classes[c]
+                b['splits'] += 1
+                b['ents'] += node['ents']
+                b['time'] += split['time']
+                b['etps'] += split['etps']
+        return { 'nodes': self.nodes, 'classes': classes, 'depths': depths,
+                 'etps': self.netps }
+
+    # summary: prints the totals as tables.
+    def summary(self, fp=sys.stdout):
+        report = self.report()
+        fp.write('%-24s %8s %10s %10s %10s\n' %
+                 ('class', 'splits', 'entries', 'time', 'etps'))
+        for (c,b) in sorted(report['classes'].items(),
+                            key=lambda x:x[1]['time'], reverse=True):
+            fp.write('%-24s %8d %10d %10.3f %10d\n' %
+                     (c, b['splits'], b['ents'], b['time'], b['etps']))
+        fp.write('\n%-24s %8s %10s %10s %10s\n' %
+                 ('depth', 'nodes', 'entries', 'time', 'etps'))
+        for (d,a) in sorted(report['depths'].items(), key=lambda x:int(x[0])):
+            fp.write('%-24s %8d %10d %10.3f %10d\n' %
+                     (d, a['nodes'], a['ents'], a['time'], a['etps']))
+        return
+
+
 ##  TreeBuilder
 ##
 class TreeBuilder:
 
-    def __init__(self, minkeys=10, minetp=0.10, debug=1):
+    def __init__(self, minkeys=10, minetp=0.10, profiler=None):
         self.keyprop = None
         self.features = {}
         self.minkeys = minkeys
         self.minetp = minetp
-        self.debug = debug
+        self.profiler = profiler
         return
 
     def addfeat(self, feat):
@@ -331,55 +813,576 @@ class TreeBuilder:
         else:
             return TreeLeaf(tree)
 
-    def build(self, ents, depth=0):
-        keys = countkeys( e[self.keyprop] for e in ents )
-        etp = calcetp(keys.values())
-        ind = '  '*depth
-        if self.debug:
-            print ('%sBuild: %r, etp=%.3f' % (ind, keys, etp))
-        if etp < self.minetp:
-            if self.debug:
-                print ('%s Too little entropy. Stopping.' % ind)
-            return None
-        if len(ents) < self.minkeys:
-            if self.debug:
-                print ('%s Too few keys. Stopping.' % ind)
-            return None
+    # setbins: divides the quantitative features into quantiles.
+    def setbins(self, ents, nbins, exactkeys=0):
+        for feat in self.features.values():
+            if isinstance(feat, QuantitativeFeature):
+                feat.setbins(ents, nbins, exactkeys)
+        return
+
+    # presort: sorts the entries for each feature.
+    def presort(self, ents):
+        presorted = {}
+        for feat in self.features.values():
+            pairs = feat.presort(ents)
+            if pairs is not None:
+                presorted[feat.name] = pairs
+        return presorted
+
+    # evaluate: splits entries with each feature and returns
+    #   the split with the minimum entropy as (etp, feat, arg, split).
+    def evaluate(self, ents, presorted, hist):
+        minbranch = None
+        for feat in self.features.values():
+            if feat.name in presorted:
+                args = (ents, self.keyprop, presorted[feat.name])
+            else:
+                args = (ents, self.keyprop)
+            try:
+                if self.profiler is None:
+                    (etp, arg, split) = feat.split(*args, hist=hist)
+                else:
+                    (etp, arg, split) = self.profiler.split(
+                        feat, feat.split, *args, hist=hist)
+            except Feature.InvalidSplit:
+                continue
+            if minbranch is None or etp < minbranch[0]:
+                minbranch = (etp, feat, arg, split)
+        return minbranch
+
+    # choose: chooses a feature to split entries.
+    #   Returns (feat, arg, default, split) or None if it stops here.
+    def choose(self, ents, depth=0, presorted=None, hist=None):
+        if self.profiler is not None:
+            self.profiler.node(depth, len(ents))
+        if hist is None:
+            hist = KeyHistogram(ents, self.keyprop)
+        if hist.etp() < self.minetp: return None
+        if len(ents) < self.minkeys: return None
+        minbranch = self.evaluate(ents, presorted or {}, hist)
+        if minbranch is None: return None
+        (etp, feat, arg, split) = minbranch
+        return (feat, arg, hist.best(), split)
+
+    # leaf: makes a leaf for entries that are not split further.
+    def leaf(self, ents, v, depth=0, hist=None):
+        if hist is None:
+            hist = KeyHistogram(ents, self.keyprop)
+        return TreeLeaf(hist.best())
+
+    def build(self, ents, depth=0, presorted=None, hist=None):
+        if presorted is None:
+            # Sort the entries only once for each feature.
+            presorted = self.presort(ents)
+        node = self.choose(ents, depth, presorted, hist)
+        if node is None: return None
+        (feat, arg, default, split) = node
+        pos = {}
+        for (i,(_,es)) in enumerate(split):
+            for (j,e) in enumerate(es):
+                pos[id(e)] = (i, j)
+        parts = { name: partition(pairs, split, pos)
+                  for (name,pairs) in presorted.items() }
+        children = {}
+        for (i,(v,es)) in enumerate(split):
+            # The histogram is shared with the leaf if it stops.
+            hist = KeyHistogram(es, self.keyprop)
+            branch = self.build(es, depth+1,
+                                { name: a[i] for (name,a) in parts.items() },
+                                hist)
+            if branch is None:
+                branch = self.leaf(es, v, depth, hist)
+            children[v] = branch
+        return TreeBranch(feat, arg, default, children)
+
+
+##  ParallelTreeBuilder
+##  TreeBuilder with a pool of worker processes.
+##  Features are evaluated in parallel at the top nodes, and once
+##  there are as many nodes as workers, each subtree is built
+##  by a worker. Workers are forked with the entries and receive
+##  the rows of each node through shared memory.
+##  A profiler records only the nodes built by the main process.
+##
+class ParallelTreeBuilder(TreeBuilder):
+
+    def __init__(self, minkeys=10, minetp=0.10, profiler=None,
+                 nworkers=2):
+        TreeBuilder.__init__(self, minkeys=minkeys, minetp=minetp,
+                             profiler=profiler)
+        self.nworkers = nworkers
+        self._pool = None
+        self._index = None
+        return
+
+    # share: puts the rows of entries in a shared memory block.
+    def share(self, ents):
+        shm = SharedMemory(create=True, size=8*len(ents))
+        rows = shm.buf.cast('q')
+        for (i,e) in enumerate(ents):
+            rows[i] = self._index[id(e)]
+        rows.release()
+        return shm
+
+    def evaluate(self, ents, presorted, hist):
+        if self._pool is None:
+            return TreeBuilder.evaluate(self, ents, presorted, hist)
+        shm = self.share(ents)
+        try:
+            tasks = [ (feat.name, shm.name, len(ents))
+                      for feat in self.features.values() ]
+            results = self._pool.map(_evalfeat, tasks)
+        finally:
+            shm.close()
+            shm.unlink()
+        minfeat = minetp = None
+        for (feat,(etp,elapsed,netps)) in zip(self.features.values(), results):
+            if self.profiler is not None:
+                self.profiler.record(feat, elapsed, netps)
+            if etp is None: continue
+            if minfeat is None or etp < minetp:
+                minetp = etp
+                minfeat = feat
+        if minfeat is None: return None
+        # Only the best split is taken locally.
+        (etp, arg, split) = minfeat.split(ents, self.keyprop, hist=hist)
+        return (etp, minfeat, arg, split)
+
+    def build(self, ents, depth=0, presorted=None, hist=None):
+        if presorted is not None or self.nworkers < 2:
+            return TreeBuilder.build(self, ents, depth, presorted, hist)
+        global _worker
+        _worker = (self, ents)
+        self._index = { id(e): i for (i,e) in enumerate(ents) }
+        try:
+            # Workers share the tracker of shared memory blocks.
+            resource_tracker.ensure_running()
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(self.nworkers) as pool:
+                self._pool = pool
+                root = self.buildpar(ents, depth)
+        finally:
+            self._pool = None
+            self._index = None
+            _worker = None
+        return root
+
+    # buildpar: builds the top nodes breadth-first and
+    #   the rest of the subtrees in parallel.
+    def buildpar(self, ents, depth=0):
+        top = {}
+        nodes = [(ents, depth, top, None)]
+        while nodes and len(nodes) < self.nworkers:
+            (es, d, parent, v) = nodes.pop(0)
+            hist = KeyHistogram(es, self.keyprop)
+            node = self.choose(es, d, hist=hist)
+            if node is None:
+                if parent is not top:
+                    parent[v] = self.leaf(es, v, d-1, hist)
+                continue
+            (feat, arg, default, split) = node
+            children = {}
+            for (v1,es1) in split:
+                children[v1] = None
+                nodes.append((es1, d+1, children, v1))
+            parent[v] = TreeBranch(feat, arg, default, children)
+        tasks = []
+        try:
+            for (es, d, parent, v) in nodes:
+                shm = self.share(es)
+                tasks.append((shm, self._pool.apply_async(
+                    _buildsub, (shm.name, len(es), d))))
+            for ((es, d, parent, v), (_, result)) in zip(nodes, tasks):
+                tree = result.get()
+                if tree is not None:
+                    tree = self.import_tree(tree)
+                elif parent is not top:
+                    tree = self.leaf(es, v, d-1)
+                parent[v] = tree
+        finally:
+            for (shm, _) in tasks:
+                shm.close()
+                shm.unlink()
+        return top.get(None)
+
+# _getrows: reads the rows of a node from a shared memory block.
+def _getrows(name, n):
+    shm = SharedMemory(name)
+    rows = shm.buf.cast('q')
+    a = rows[:n].tolist()
+    rows.release()
+    shm.close()
+    return a
+
+# _evalfeat: evaluates a feature in a worker process.
+def _evalfeat(args):
+    (name, shmname, n) = args
+    (builder, ents) = _worker
+    es = [ ents[i] for i in _getrows(shmname, n) ]
+    netps = 0 if builder.profiler is None else builder.profiler.netps
+    t0 = time.perf_counter()
+    try:
+        (etp, _, _) = builder.features[name].split(es, builder.keyprop)
+    except Feature.InvalidSplit:
+        etp = None
+    elapsed = time.perf_counter() - t0
+    if builder.profiler is not None:
+        netps = builder.profiler.netps - netps
+    return (etp, elapsed, netps)
+
+# _buildsub: builds a subtree in a worker process.
+def _buildsub(shmname, n, depth):
+    (builder, ents) = _worker
+    es = [ ents[i] for i in _getrows(shmname, n) ]
+    tree = TreeBuilder.build(builder, es, depth)
+    if tree is None: return None
+    return export_tree(tree)
+
+_worker = None
+
+
+##  ColumnSet
+##  Entries encoded into NumPy arrays.
+##
+class ColumnSet:
+
+    def __init__(self, ents, keyprop, features):
+        self.ents = ents
+        index = {}
+        kcodes = []
+        for e in ents:
+            k = e[keyprop]
+            if k not in index:
+                index[k] = len(index)
+            kcodes.append(index[k])
+        self.keys = list(index.keys())
+        self.nkeys = len(self.keys)
+        self.kcodes = np.array(kcodes, dtype=np.intp)
+        self.cols = {}
+        for feat in features:
+            col = feat.encode(ents)
+            if col is not None:
+                self.cols[feat.name] = col
+        self._rows = None
+        return
+
+    def __len__(self):
+        return len(self.ents)
+
+    # getents: returns the entries of given rows.
+    def getents(self, rows):
+        return [ self.ents[i] for i in rows ]
+
+    # getrows: returns the rows of given entries.
+    def getrows(self, ents):
+        if self._rows is None:
+            self._rows = { id(e): i for (i,e) in enumerate(self.ents) }
+        return np.array([ self._rows[id(e)] for e in ents ], dtype=np.intp)
+
+
+##  ColumnTreeBuilder
+##  TreeBuilder with a NumPy columnar backend.
+##  Nodes with fewer than minrows entries are built with TreeBuilder.
+##
+class ColumnTreeBuilder(TreeBuilder):
+
+    def __init__(self, minkeys=10, minetp=0.10, profiler=None,
+                 minrows=1000):
+        if np is None:
+            raise ImportError('ColumnTreeBuilder requires numpy')
+        TreeBuilder.__init__(self, minkeys=minkeys, minetp=minetp,
+                             profiler=profiler)
+        self.minrows = minrows
+        return
+
+    def build(self, ents, depth=0, presorted=None, hist=None):
+        if presorted is not None:
+            return TreeBuilder.build(self, ents, depth, presorted, hist)
+        cs = ColumnSet(ents, self.keyprop, self.features.values())
+        return self.buildrows(cs, np.arange(len(cs)), depth)
+
+    # colsplit: splits rows with a feature, falling back to
+    #   the ordinary split if the feature is not encoded.
+    def colsplit(self, feat, cs, rows):
+        if feat.name in cs.cols:
+            return feat.colsplit(cs, rows)
+        (etp, arg, split) = feat.split(cs.getents(rows), self.keyprop)
+        split = [ (v, cs.getrows(es)) for (v,es) in split ]
+        return (etp, arg, split)
+
+    def buildrows(self, cs, rows, depth=0):
+        if len(rows) < self.minrows:
+            ents = cs.getents(rows)
+            return TreeBuilder.build(self, ents, depth, self.presort(ents))
+        if self.profiler is not None:
+            self.profiler.node(depth, len(rows))
+        kcodes = cs.kcodes[rows]
+        if calcetp(colcounts(kcodes)) < self.minetp: return None
+        if len(rows) < self.minkeys: return None
         minbranch = minetp = None
         for feat in self.features.values():
             try:
-                (etp, arg, split) = feat.split(ents, self.keyprop)
+                if self.profiler is None:
+                    (etp, arg, split) = self.colsplit(feat, cs, rows)
+                else:
+                    (etp, arg, split) = self.profiler.split(
+                        feat, self.colsplit, feat, cs, rows)
             except Feature.InvalidSplit:
                 continue
             if minbranch is None or etp < minetp:
                 minetp = etp
                 minbranch = (feat, arg, split)
-        if minbranch is None:
-            if self.debug:
-                print ('%s No discerning feature. Stopping.' % ind)
-            return None
+        if minbranch is None: return None
         (feat, arg, split) = minbranch
-        if self.debug:
-            print ('%sFeature: %r, arg=%r, etp=%.3f' % (ind, feat, arg, etp))
-        default = argmax(keys)
+        default = cs.keys[colargmax(kcodes)]
         children = {}
-        for (i,(v,es)) in enumerate(split):
-            if 2 <= self.debug:
-                r = [ (e[feat.attr], e.key) for e in es ]
-                print ('%s Split%d (%d): %r, %r' % (ind, i, len(r), v, r))
-            if self.debug:
-                print ('%s Value: %r ->' % (ind, v))
-            branch = self.build(es, depth+1)
+        for (v,a) in split:
+            branch = self.buildrows(cs, a, depth+1)
             if branch is None:
-                keys = countkeys( e[self.keyprop] for e in es )
-                best = argmax(keys)
-                if self.debug:
-                    print ('%s Leaf: %r -> %r' % (ind, v, best))
-                branch = TreeLeaf(best)
+                branch = TreeLeaf(cs.keys[colargmax(cs.kcodes[a])])
             children[v] = branch
         return TreeBranch(feat, arg, default, children)
 
 
+##  RandomForest
+##  Trees built on bootstrap samples of entries, each with
+##  a random subset of features. The trees vote for a key.
+##
+class RandomForest:
+
+    def __init__(self, builder, ntrees=10, nfeats=None, nworkers=1, seed=0):
+        self.builder = builder
+        self.ntrees = ntrees
+        self.nfeats = nfeats
+        self.nworkers = nworkers
+        self.seed = seed
+        self.trees = []
+        self._compiled = None
+        return
+
+    def __len__(self):
+        return len(self.trees)
+
+    def import_forest(self, data):
+        self.trees = [ self.builder.import_tree(tree)
+                       for tree in data['trees'] ]
+        self._compiled = None
+        return
+
+    # buildone: builds a tree from a bootstrap sample.
+    def buildone(self, ents, seed):
+        rng = random.Random(seed)
+        feats = list(self.builder.features.values())
+        nfeats = self.nfeats or max(1, round(sqrt(len(feats))))
+        chosen = rng.sample(feats, min(nfeats, len(feats)))
+        builder = copy.copy(self.builder)
+        builder.features = { feat.name: feat for feat in feats
+                             if feat in chosen }
+        # Each entry in the sample must be a distinct object.
+        sample = []
+        used = set()
+        for _ in range(len(ents)):
+            e = ents[rng.randrange(len(ents))]
+            if id(e) in used:
+                e = copy.copy(e)
+            else:
+                used.add(id(e))
+            sample.append(e)
+        tree = builder.build(sample)
+        if tree is None:
+            tree = builder.leaf(sample, None)
+        return tree
+
+    def build(self, ents):
+        seeds = [ self.seed+i for i in range(self.ntrees) ]
+        if self.nworkers < 2:
+            self.trees = [ self.buildone(ents, seed) for seed in seeds ]
+        else:
+            global _worker
+            _worker = (self, ents)
+            try:
+                ctx = multiprocessing.get_context('fork')
+                with ctx.Pool(self.nworkers) as pool:
+                    data = pool.map(_buildtree, seeds)
+            finally:
+                _worker = None
+            self.trees = []
+            for (tree, records) in data:
+                if records is not None:
+                    self.builder.profiler.merge(*records)
+                self.trees.append(self.builder.import_tree(tree))
+        self._compiled = None
+        return self.trees
+
+    # predict: returns the key voted by the most trees.
+    def predict(self, e):
+        if self._compiled is None:
+            self._compiled = [ CompiledTree(tree) for tree in self.trees ]
+        return argmax(countkeys( tree.predict(e) for tree in self._compiled ))
+
+    # predict_many: predicts the keys of entries one by one.
+    def predict_many(self, ents):
+        for e in ents:
+            yield self.predict(e)
+        return
+
+# _buildtree: builds a tree of a forest in a worker process.
+#   The profiler records of the tree are returned with it.
+def _buildtree(seed):
+    (forest, ents) = _worker
+    profiler = forest.builder.profiler
+    if profiler is None:
+        return (export_tree(forest.buildone(ents, seed)), None)
+    (n, netps) = (len(profiler.nodes), profiler.netps)
+    tree = export_tree(forest.buildone(ents, seed))
+    return (tree, (profiler.nodes[n:], profiler.netps-netps))
+
+# export_forest
+def export_forest(forest):
+    return { 'trees': [ export_tree(tree) for tree in forest.trees ] }
+
+
+# readents: reads entries from JSON lines or CSV rows one by one.
+def readents(fp, usecsv=False):
+    import json
+    if usecsv:
+        import csv
+        props = None
+        for row in csv.reader(fp):
+            if props is None:
+                props = row
+            else:
+                yield dict(zip(props, row))
+    else:
+        for line in fp:
+            yield json.loads(line)
+    return
+
+
+##  Entry
+##  A compact record that can be used in place of a dict.
+##  Each subclass made by entryclass() has its own property index.
+##  Absent properties are stored as MISSING.
+##
+MISSING = Ellipsis
+
+class Entry:
+
+    __slots__ = ('values',)
+    props = {}
+
+    def __init__(self, values):
+        self.values = values
+        return
+
+    def __repr__(self):
+        return ('<Entry: %r>' % dict(self.items()))
+
+    def __getitem__(self, prop):
+        i = self.props[prop]
+        if len(self.values) <= i: raise KeyError(prop)
+        v = self.values[i]
+        if v is MISSING: raise KeyError(prop)
+        return v
+
+    def get(self, prop, default=None):
+        try:
+            return self[prop]
+        except KeyError:
+            return default
+
+    def items(self):
+        for (prop,i) in self.props.items():
+            if i < len(self.values) and self.values[i] is not MISSING:
+                yield (prop, self.values[i])
+        return
+
+# entryclass: makes an Entry class for given properties.
+def entryclass(props):
+    props = { p:i for (i,p) in enumerate(props) }
+    return type('Entry', (Entry,), {'__slots__': (), 'props': props})
+
+# loadents: parses entries into compact records.
+#   Strings are interned so that repeated values share one object.
+def loadents(fp, usecsv=False):
+    import json
+    intern = sys.intern
+    ents = []
+    if usecsv:
+        import csv
+        cls = None
+        for row in csv.reader(fp):
+            if cls is None:
+                cls = entryclass(row)
+            else:
+                ents.append(cls(tuple( intern(v) for v in row )))
+    else:
+        cls = entryclass([])
+        props = cls.props
+        keys = index = None
+        for line in fp:
+            e = json.loads(line)
+            if keys != tuple(e):
+                # The properties are looked up only when they change.
+                keys = tuple(e)
+                for k in keys:
+                    if k not in props:
+                        props[intern(k)] = len(props)
+                index = [ props[k] for k in keys ]
+                if index == list(range(len(props))):
+                    index = None
+            if index is None:
+                values = e.values()
+            else:
+                values = [MISSING]*len(props)
+                for (i,v) in zip(index, e.values()):
+                    values[i] = v
+            ents.append(cls(tuple( intern(v) if type(v) is str else v
+                                   for v in values )))
+    return ents
+
+# savecache: writes compact entries to a cache file.
+#   stamps identify the input files the entries were read from.
+CACHE_MAGIC = b'DTREE\x00\x00\x01'
+def savecache(path, ents, stamps):
+    props = list(ents[0].props.keys()) if ents else []
+    header = marshal.dumps((stamps, props))
+    with open(path, 'wb') as fp:
+        fp.write(CACHE_MAGIC)
+        fp.write(struct.pack('<Q', len(header)))
+        fp.write(header)
+        marshal.dump([ e.values for e in ents ], fp)
+    return
+
+# loadcache: reads entries from a cache file with mmap.
+#   Returns None if the file is not made from the same inputs.
+def loadcache(path, stamps):
+    with open(path, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(CACHE_MAGIC)] != CACHE_MAGIC: return None
+            i = len(CACHE_MAGIC)+8
+            (n,) = struct.unpack('<Q', mm[i-8:i])
+            (stamps1, props) = marshal.loads(mm[i:i+n])
+            if stamps1 != stamps: return None
+            buf = memoryview(mm)[i+n:]
+            try:
+                rows = marshal.loads(buf)
+            finally:
+                buf.release()
+    cls = entryclass(props)
+    return [ cls(values) for values in rows ]
+
+# getstamps: returns the names, sizes and mtimes of input files.
+#   Returns None if any input is stdin, which cannot be identified.
+def getstamps(args):
+    if not args or '-' in args: return None
+    stamps = []
+    for path in args:
+        st = os.stat(path)
+        stamps.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
+    return stamps
+
+
 ##  Setup Features
 ##
 def setup(builder):
@@ -396,63 +1399,123 @@ def main(argv):
     import getopt
     import fileinput
     def usage():
-        print('usage: %s [-d] [-C] [-f feats] [-m minkeys] [file ...]' %
+        print('usage: %s [-d] [-C] [-N] [-j nworkers] [-F ntrees] [-c cache] '
+              '[-b nbins [-x exactkeys]] [-P report] [-f feats [-p]] '
+              '[-m minkeys] [file ...]' %
               argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dCf:m:')
+        (opts, args) = getopt.getopt(argv[1:], 'dCNj:F:c:b:x:P:f:pm:')
     except getopt.GetoptError:
         return usage()
     debug = 0
     usecsv = False
+    usenumpy = False
+    cache = None
     feats = None
+    predict = False
     minkeys = 1
+    nworkers = 1
+    ntrees = 0
+    nbins = 0
+    exactkeys = 0
+    report = None
     for (k, v) in opts:
         if k == '-d': debug += 1
         elif k == '-C': usecsv = True
+        elif k == '-N': usenumpy = True
+        elif k == '-c': cache = v
         elif k == '-f': feats = v
+        elif k == '-p': predict = True
         elif k == '-m': minkeys = int(v)
-
-    builder = TreeBuilder(minkeys=minkeys, debug=debug)
+        elif k == '-j': nworkers = int(v)
+        elif k == '-F': ntrees = int(v)
+        elif k == '-b': nbins = int(v)
+        elif k == '-x': exactkeys = int(v)
+        elif k == '-P': report = v
+
+    if usenumpy:
+        builder = ColumnTreeBuilder(minkeys=minkeys)
+    elif 1 < nworkers and not ntrees:
+        builder = ParallelTreeBuilder(minkeys=minkeys, nworkers=nworkers)
+    else:
+        builder = TreeBuilder(minkeys=minkeys)
     setup(builder)
-
-    ents = []
-    fp = fileinput.input(args)
-    if usecsv:
-        import csv
-        props = None
-        for row in csv.reader(fp):
-            if props is None:
-                props = row
-            else:
-                e = dict(zip(props, row))
-                ents.append(e)
+    if report is not None:
+        builder.profiler = TreeProfiler()
+
+    stamps = None
+    if cache is not None:
+        stamps = getstamps(args)
+        if stamps is None:
+            print('cache ignored: stdin input', file=sys.stderr)
+    if stamps is not None:
+        # Parse the input only if the cache is not made from it.
+        ents = None
+        if os.path.exists(cache):
+            ents = loadcache(cache, stamps)
+        if ents is None:
+            ents = loadents(fileinput.input(args), usecsv=usecsv)
+            savecache(cache, ents, stamps)
+    elif feats is None:
+        ents = loadents(fileinput.input(args), usecsv=usecsv)
     else:
-        for line in fp:
-            e = json.loads(line)
-            ents.append(e)
+        ents = readents(fileinput.input(args), usecsv=usecsv)
 
     if feats is None:
-        # Training
-        root = builder.build(ents)
-        if debug:
-            print()
-            root.dump()
-        print(json.dumps(export_tree(root)))
+        if nbins:
+            builder.setbins(ents, nbins, exactkeys)
+        if ntrees:
+            # Training a forest
+            model = RandomForest(builder, ntrees=ntrees, nworkers=nworkers)
+        else:
+            # Training a tree
+            model = builder
+        if builder.profiler is not None:
+            with builder.profiler:
+                root = model.build(ents)
+            with open(report, 'w') as fp:
+                json.dump(builder.profiler.report(), fp)
+            builder.profiler.summary(sys.stderr)
+        else:
+            root = model.build(ents)
+        if ntrees:
+            print(json.dumps(export_forest(model)))
+        else:
+            if debug:
+                print()
+                root.dump()
+            print(json.dumps(export_tree(root)))
 
     else:
         # Testing
         with open(feats) as fp:
             data = json.loads(fp.read())
-        tree = builder.import_tree(data)
+        if isinstance(data, dict):
+            tree = RandomForest(builder)
+            tree.import_forest(data)
+        else:
+            tree = CompiledTree(builder.import_tree(data))
+        keyprop = builder.keyprop
+        if predict:
+            # Prediction
+            if usecsv:
+                import csv
+                out = csv.writer(sys.stdout)
+                out.writerow([keyprop])
+                for key in tree.predict_many(ents):
+                    out.writerow([key])
+            else:
+                for key in tree.predict_many(ents):
+                    print(json.dumps(key))
+            return 0
         keys = {}     # given keys
         resp = {}     # given responses
         correct = {}  # correct responses
-        keyprop = builder.keyprop
         for e in ents:
             ref = e[keyprop]
             keys[ref] = keys.get(ref,0)+1
-            key = tree.test(e)
+            key = tree.predict(e)
             resp[key] = resp.get(key,0)+1
             if e[keyprop] == key:
                 correct[key] = correct.get(key,0)+1
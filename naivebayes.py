@@ -1,7 +1,24 @@
 #!/usr/bin/env python
+import os
 import sys
 import math
+import json
+import mmap
+import struct
 import marshal
+from array import array
+from itertools import chain
+from collections import OrderedDict, Counter
+from collections.abc import Mapping
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# countids: returns the number of sets each id is in.
+def countids(idsets):
+    return Counter(chain.from_iterable(idsets))
 
 class NaiveBayes:
 
@@ -29,11 +46,40 @@ class NaiveBayes:
 [('banana', [50, ('long', 40), ('sweet', 35), ('yellow', 45)]), ('other', [20, ('long', 10), ('sweet', 15), ('yellow', 5)])]
 >>> [ p for (p,_) in keys ] == [ p for (p,_,_) in keyfeats ]
 True
+>>> b.getkeys_many([['long','sweet','yellow'], ['sweet']]) == [keys, b.getkeys(['sweet'])]
+True
+>>> c = NaiveBayes()
+>>> c.add('orange', ['round'], 5)
+>>> b.merge(c)
+>>> b.kcount
+{'banana': 50, 'orange': 35, 'other': 20}
+>>> b.fcount['round']
+{None: 5, 'orange': 5}
+>>> b.remove('other', ['yellow','long'], 5)
+>>> (nfeats, ncells, _, _) = b.compact(mincount=10)
+>>> (nfeats, ncells)
+(1, 2)
+>>> b.fcount['yellow']
+{None: 75, 'banana': 45, 'orange': 30}
+>>> b.setcache(100)
+>>> b.getkeys(['long','sweet']) == b.getkeys(['long','sweet'])
+True
+>>> (b.cachehits, b.cachemisses)
+(1, 1)
+>>> b.add('other', ['long','sweet'], 5)
+>>> keys = b.getkeys(['long','sweet'])
+>>> (b.cachehits, b.cachemisses)
+(1, 2)
 """
 
     def __init__(self):
         self.fcount = {}
         self.kcount = {}
+        self._logtab = None
+        self._index = None
+        self._cache = None
+        self.cachesize = 0
+        self.cachehits = self.cachemisses = 0
         return
 
     def __len__(self):
@@ -45,6 +91,7 @@ True
 
     def adddict(self, key, count, feats):
         assert key is not None
+        self._changed()
         if key not in self.kcount:
             self.kcount[key] = 0
         self.kcount[key] += count
@@ -57,6 +104,8 @@ True
                 d[key] = 0
             d[key] += c
             d[None] += c
+            if self._index is not None:
+                self._setcell(f, key, d[key])
         return
 
     def remove(self, key, feats, c=1):
@@ -66,6 +115,7 @@ True
     def removedict(self, key, count, feats):
         assert key is not None
         assert key in self.kcount
+        self._changed()
         self.kcount[key] -= count
         for (f,c) in feats.items():
             assert f in self.fcount
@@ -73,8 +123,106 @@ True
             assert key in d
             d[key] -= c
             d[None] -= c
+            if self._index is not None:
+                self._setcell(f, key, d[key])
+        return
+
+    # merge: adds the counts of another model.
+    def merge(self, other):
+        self._changed()
+        self._index = None
+        for (k,c) in other.kcount.items():
+            if k not in self.kcount:
+                self.kcount[k] = 0
+            self.kcount[k] += c
+        for (f,d1) in other.fcount.items():
+            if f in self.fcount:
+                d = self.fcount[f]
+            else:
+                d = self.fcount[f] = {None:0}
+            for (k,c) in d1.items():
+                if k not in d:
+                    d[k] = 0
+                d[k] += c
         return
 
+    # setcache: keeps the results of the last size queries of
+    #   getkeys() and narrow(). size=0 disables the cache.
+    def setcache(self, size):
+        self.cachesize = size
+        self._cache = OrderedDict() if 0 < size else None
+        self.cachehits = self.cachemisses = 0
+        return
+
+    # _changed: discards everything computed from the counts.
+    def _changed(self):
+        self._logtab = None
+        if self._cache is not None:
+            self._cache.clear()
+        return
+
+    # _cached: returns func() for the query key from the cache.
+    def _cached(self, key, func):
+        if key in self._cache:
+            self.cachehits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.cachemisses += 1
+        v = self._cache[key] = func()
+        if self.cachesize < len(self._cache):
+            self._cache.popitem(last=False)
+        return v
+
+    # getsize: returns the approximate number of bytes used by the counts.
+    def getsize(self):
+        return (sys.getsizeof(self.fcount) + sys.getsizeof(self.kcount) +
+                sum( sys.getsizeof(d) for d in self.fcount.values() ))
+
+    # getgain: returns the information gain of each feature in bits.
+    def getgain(self):
+        def h(n, s):
+            return (math.log2(n) - s/n) if 0 < n else 0.0
+        def clogc(c):
+            return c*math.log2(c) if 0 < c else 0.0
+        n = sum(self.kcount.values())
+        s = sum( clogc(c) for c in self.kcount.values() )
+        hk = h(n, s)
+        gain = {}
+        for (f,d) in self.fcount.items():
+            # s1: entropy term of the entries with f, s0: without f.
+            (n1, s1, s0) = (d[None], 0.0, s)
+            for (k,c) in d.items():
+                if k is None: continue
+                kc = self.kcount.get(k, 0)
+                s1 += clogc(c)
+                s0 += clogc(max(0, kc-c)) - clogc(kc)
+            n0 = max(0, n-n1)
+            gain[f] = hk - (n1*h(n1, s1) + n0*h(n0, s0))/n if 0 < n else 0.0
+        return gain
+
+    # compact: removes zero counts and features that have fewer than
+    #   mincount occurrences or less than mingain bits of information.
+    #   Returns (removed features, removed cells, bytes before, bytes after).
+    def compact(self, mincount=0, mingain=0.0):
+        self._changed()
+        self._index = None
+        size0 = self.getsize()
+        gain = self.getgain() if 0 < mingain else None
+        (nfeats, ncells) = (0, 0)
+        fcount = {}
+        for (f,d) in self.fcount.items():
+            if d[None] <= 0 or d[None] < mincount or (
+                    gain is not None and gain[f] < mingain):
+                nfeats += 1
+                ncells += len(d)-1
+                continue
+            d1 = { k:c for (k,c) in d.items() if k is None or c != 0 }
+            ncells += len(d)-len(d1)
+            fcount[f] = d1
+        self.fcount = fcount
+        self.kcount = { k:c for (k,c) in self.kcount.items() if c != 0 }
+        return (nfeats, ncells, size0, self.getsize())
+
     def dump(self, threshold=2, ntop=10):
         key2feats = self.getfeats(threshold=threshold)
         for (k,n) in sorted(self.kcount.items(), key=lambda x:x[1], reverse=True):
@@ -107,10 +255,119 @@ True
     def load(self, fp):
         data = marshal.load(fp)
         (self.fcount, self.kcount) = data
+        self._changed()
+        self._index = None
         self.validate()
         return
 
+    # savemap: writes the model in the format read by MappedNaiveBayes.
+    def savemap(self, fp):
+        keys = list(self.kcount.keys())
+        kids = { k:i for (i,k) in enumerate(keys) }
+        kblob = marshal.dumps(keys)
+        kblob += bytes(-len(kblob) % 8)
+        # features are sorted by their marshaled names for binary search.
+        fnames = sorted( (marshal.dumps(f, 0), f) for f in self.fcount )
+        foffs = array('Q', [0])
+        ftotal = array('q')
+        indptr = array('Q', [0])
+        counts = array('q')
+        cellkeys = array('I')
+        for (name,f) in fnames:
+            foffs.append(foffs[-1]+len(name))
+            d = self.fcount[f]
+            ftotal.append(d[None])
+            for (k,c) in d.items():
+                if k is None: continue
+                cellkeys.append(kids[k])
+                counts.append(c)
+            indptr.append(len(counts))
+        assert sys.byteorder == 'little'
+        fp.write(MAP_MAGIC)
+        fp.write(struct.pack('<4Q', len(keys), len(fnames), len(counts),
+                             len(kblob)))
+        fp.write(kblob)
+        for a in (array('q', self.kcount.values()), foffs, ftotal, indptr,
+                  counts, cellkeys):
+            a.tofile(fp)
+        for (name,_) in fnames:
+            fp.write(name)
+        return
+
+    # _getindex: returns the key ids and the key ids of each feature.
+    #   Features are added to it lazily by _getkeyids.
+    def _getindex(self):
+        if self._index is None:
+            kids = { k:i for (i,k) in enumerate(self.kcount) }
+            self._index = (kids, list(self.kcount), {})
+        return self._index
+
+    # _getkeyids: returns two sets of key ids for a feature: the keys
+    #   that have an entry and the keys with a nonzero count. They are
+    #   built on the first use and then kept up to date by add/remove.
+    def _getkeyids(self, f):
+        (kids, _, cells) = self._getindex()
+        if f not in cells:
+            (exists, nonzero) = (set(), set())
+            for (k,c) in self.fcount[f].items():
+                if k is None: continue
+                exists.add(kids[k])
+                if c != 0:
+                    nonzero.add(kids[k])
+            cells[f] = (exists, nonzero)
+        return cells[f]
+
+    def _setcell(self, f, key, c):
+        (kids, keys, cells) = self._index
+        if key not in kids:
+            kids[key] = len(keys)
+            keys.append(key)
+        if f not in cells: return
+        (exists, nonzero) = cells[f]
+        exists.add(kids[key])
+        if c != 0:
+            nonzero.add(kids[key])
+        else:
+            nonzero.discard(kids[key])
+        return
+
     def narrow(self, feats, ratio):
+        if self._cache is None:
+            return self._narrow(feats, ratio)
+        feats = tuple(feats)
+        return set(self._cached(('narrow', feats, ratio),
+                                lambda: self._narrow(feats, ratio)))
+
+    # _narrow: narrow() using the key ids of each feature.
+    def _narrow(self, feats, ratio):
+        rows = [ (f, self._getkeyids(f)[0]) for f in feats
+                 if f in self.fcount ]
+        counts = countids( ids for (_,ids) in rows )
+        if not counts: return self._narrowscan(feats, ratio)
+        n = max(1, math.ceil(ratio * max(counts.values())))
+        keys = set( i for (i,c) in counts.items() if n <= c )
+        f2 = set( f for (f,ids) in rows if keys <= ids )
+        if not f2:
+            # the scan restarts the intersection when it becomes empty,
+            # so the keys are intersected in the order of the scan.
+            (kids, _, _) = self._getindex()
+            seen = set()
+            for f in feats:
+                if f not in self.fcount: continue
+                for k in self.fcount[f]:
+                    if k is None: continue
+                    i = kids[k]
+                    if i not in keys or i in seen: continue
+                    seen.add(i)
+                    a = set( f1 for (f1,ids) in rows if i in ids )
+                    if not f2:
+                        f2 = a
+                    else:
+                        f2.intersection_update(a)
+                if len(seen) == len(keys): break
+        return f2
+
+    def _narrowscan(self, feats, ratio):
         key2feats = {}
         for f in feats:
             if f not in self.fcount: continue
@@ -132,6 +389,14 @@ True
         return f2
 
     def getkeys(self, feats, n=0, fallback=False):
+        if self._cache is None:
+            return self._getkeys(feats, n, fallback)
+        # the order of features is kept as it can change the last digits.
+        feats = tuple(feats)
+        return list(self._cached(('getkeys', feats, n, fallback),
+                                 lambda: self._getkeys(feats, n, fallback)))
+
+    def _getkeys(self, feats, n=0, fallback=False):
         # argmax P(k | f1,f2,...) = argmax P(k) P(f1,f2,...|k)
         # = argmax P(k) P(f1|k) P(f2|k), ...
         keyp = { k:math.log(v) for (k,v) in self.kcount.items() if 0 < v }
@@ -161,24 +426,25 @@ True
         return a
 
     def getkeyfeats(self, feats):
+        (_, keys, _) = self._getindex()
+        feats = [ f for f in feats if f in self.fcount ]
+        # only the keys that have the most features are taken.
+        counts = countids( self._getkeyids(f)[1] for f in feats )
+        m = max(counts.values(), default=0)
         # keyp = { k1:[P(k), P(f1|k), P(f2|k), ...], k2:[ ... ] }
         keyp = {}
-        m = 0
-        for f in feats:
-            if f not in self.fcount: continue
-            for (k,c) in self.fcount[f].items():
-                if k is None or c == 0: continue
-                if k in keyp:
-                    a = keyp[k]
-                else:
-                    a = keyp[k] = [self.kcount[k]]
-                a.append((f, c))
-                m = max(m, len(a))
+        rows = [ (f, self.fcount[f]) for f in feats ]
+        for kid in sorted( i for (i,c) in counts.items() if c == m ):
+            k = keys[kid]
+            a = keyp[k] = [self.kcount[k]]
+            for (f,d) in rows:
+                c = d.get(k, 0)
+                if c != 0:
+                    a.append((f, c))
         # compute P(k) P(f1|k) P(f2|k) for each k.
         # keyfeats = [(p1,k1,feats1), (p2,k2,feats2), ...]
         keyfeats = []
         for (k,a) in keyp.items():
-            if len(a) != m: continue
             pk = p = math.log(a[0])
             for (_,c) in a[1:]:
                 p += math.log(c) - pk
@@ -189,6 +455,76 @@ True
         pm = max( p for (p,_,_) in keyfeats )
         return [ (p-pm, k, a) for (p,k,a) in keyfeats ]
 
+    # _getlogtab: returns the keys, their log counts and their order.
+    #   Per-feature rows are added to the table lazily by _getlogrow.
+    def _getlogtab(self):
+        if self._logtab is None:
+            keys = [ k for (k,v) in self.kcount.items() if 0 < v ]
+            klogs = np.array([ math.log(self.kcount[k]) for k in keys ])
+            order = sorted(range(len(keys)), key=lambda i:keys[i])
+            krank = np.empty(len(keys), dtype=np.int64)
+            krank[order] = np.arange(len(keys))
+            self._logtab = (keys, klogs, krank, {})
+        return self._logtab
+
+    # _getlogrow: returns log P(f|k) for each key and whether f occurs with k.
+    #   Keys without f get log P(k)^-1 as in the getkeys fallback.
+    def _getlogrow(self, f):
+        (keys, klogs, _, rows) = self._getlogtab()
+        if f not in rows:
+            d = self.fcount[f]
+            present = np.array([ 0 < d.get(k, 0) for k in keys ], dtype=bool)
+            logs = np.array([ math.log(d[k]) if 0 < d.get(k, 0) else 0.0
+                              for k in keys ])
+            rows[f] = (np.where(present, logs-klogs, -klogs), present)
+        return rows[f]
+
+    # getkeys_many: getkeys() for many feature sets at once.
+    #   Log counts are computed once and kept until the model changes.
+    def getkeys_many(self, featsets, n=0, fallback=False, chunksize=1024):
+        if np is None:
+            return [ self.getkeys(feats, n, fallback) for feats in featsets ]
+        (keys, klogs, krank, _) = self._getlogtab()
+        results = []
+        featsets = [ [ f for f in feats if f in self.fcount ]
+                     for feats in featsets ]
+        for i0 in range(0, len(featsets), chunksize):
+            chunk = featsets[i0:i0+chunksize]
+            # row 0 is for documents that have no more features.
+            fids = {}
+            for feats in chunk:
+                for f in feats:
+                    if f not in fids:
+                        fids[f] = len(fids)+1
+            table = np.zeros((len(fids)+1, len(keys)))
+            present = np.ones((len(fids)+1, len(keys)), dtype=bool)
+            for (f,i) in fids.items():
+                (table[i], present[i]) = self._getlogrow(f)
+            m = max( (len(feats) for feats in chunk), default=0 )
+            index = np.zeros((len(chunk), m), dtype=np.int64)
+            for (j,feats) in enumerate(chunk):
+                index[j,:len(feats)] = [ fids[f] for f in feats ]
+            # features are added in the same order as getkeys does.
+            keyp = np.tile(klogs, (len(chunk), 1))
+            skipped = np.zeros(keyp.shape, dtype=bool)
+            for j in range(m):
+                keyp += table[index[:,j]]
+                if not fallback:
+                    skipped |= ~present[index[:,j]]
+            for (p,s) in zip(keyp, skipped):
+                # sort by (p,k) in reverse.
+                a = np.lexsort((-krank, -p))
+                a = a[~s[a]]
+                if n:
+                    a = a[:n]
+                if len(a) == 0:
+                    results.append([])
+                    continue
+                # prevent exp(x) overflow by adjusting the maximum log to zero.
+                p = (p[a] - p[a[0]]).tolist()
+                results.append([ (p1, keys[i]) for (p1,i) in zip(p, a.tolist()) ])
+        return results
+
     # for debugging
     def getkeysd(self, feats, n=0, fallback=False):
         # argmax P(k | f1,f2,...) = argmax P(k) P(f1,f2,...|k)
@@ -232,10 +568,593 @@ True
                 a.append((f, v))
         return keyfeats
 
-def main(argv):
-    nb = NaiveBayes()
-    with open(argv[1], 'rb') as fp:
+##  SparseNaiveBayes
+##  NaiveBayes with features and keys interned to integer ids.
+##  Counts are appended to flat arrays and merged into a CSR matrix
+##  (one row per feature, one column per key) when queried.
+##
+class SparseNaiveBayes:
+
+    """
+>>> b = SparseNaiveBayes()
+>>> b.add('banana', ['yellow'], 5)
+>>> b.add('banana', ['long','yellow'], 10)
+>>> b.add('banana', ['sweet','yellow'], 5)
+>>> b.add('banana', ['long','sweet'], 5)
+>>> b.add('banana', ['long','sweet','yellow'], 25)
+>>> b.add('orange', ['yellow'], 15)
+>>> b.add('orange', ['sweet','yellow'], 15)
+>>> b.add('other', ['sweet'], 10)
+>>> b.add('other', ['sweet','long'], 5)
+>>> b.add('other', ['yellow','long'], 5)
+>>> b.getkcount()
+{'banana': 50, 'orange': 30, 'other': 20}
+>>> b.getfcount('long')
+{'banana': 40, 'other': 10}
+>>> keys = b.getkeys(['long','sweet','yellow'])
+>>> [ k for (_,k) in keys ]
+['banana', 'other']
+>>> keyfeats = b.getkeyfeats(['long','sweet','yellow'])
+>>> [ (k,a) for (_,k,a) in keyfeats ]
+[('banana', [50, ('long', 40), ('sweet', 35), ('yellow', 45)]), ('other', [20, ('long', 10), ('sweet', 15), ('yellow', 5)])]
+>>> [ p for (p,_) in keys ] == [ p for (p,_,_) in keyfeats ]
+True
+>>> b.remove('other', ['yellow','long'], 5)
+>>> b.getfcount('yellow')
+{'banana': 45, 'orange': 30}
+>>> b.add('kiwi', [], 5)
+>>> [ k for (_,k) in b.getkeys(['yellow'], fallback=True) ]
+['banana', 'orange', 'other', 'kiwi']
+"""
+
+    def __init__(self):
+        if np is None:
+            raise ImportError('SparseNaiveBayes requires numpy')
+        self.keys = []
+        self.kids = {}
+        self.kcount = array('q')
+        self.feats = []
+        self.fids = {}
+        # pending counts as (feature id, key id, count).
+        self._rows = array('q')
+        self._cols = array('q')
+        self._data = array('q')
+        # merged counts as CSR.
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._logs = None
+        return
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _kid(self, key):
+        if key in self.kids:
+            return self.kids[key]
+        kid = self.kids[key] = len(self.keys)
+        self.keys.append(key)
+        self.kcount.append(0)
+        return kid
+
+    def _fid(self, f):
+        if f in self.fids:
+            return self.fids[f]
+        fid = self.fids[f] = len(self.feats)
+        self.feats.append(f)
+        return fid
+
+    def add(self, key, feats, c=1):
+        self.adddict(key, c, { f:c for f in feats })
+        return
+
+    def adddict(self, key, count, feats):
+        assert key is not None
+        kid = self._kid(key)
+        self.kcount[kid] += count
+        self._logs = None
+        for (f,c) in feats.items():
+            self._rows.append(self._fid(f))
+            self._cols.append(kid)
+            self._data.append(c)
+        return
+
+    def remove(self, key, feats, c=1):
+        self.removedict(key, c, { f:c for f in feats })
+        return
+
+    def removedict(self, key, count, feats):
+        assert key in self.kids
+        kid = self.kids[key]
+        self.kcount[kid] -= count
+        self._logs = None
+        for (f,c) in feats.items():
+            assert f in self.fids
+            self._rows.append(self.fids[f])
+            self._cols.append(kid)
+            self._data.append(-c)
+        return
+
+    # _merge: merges the pending counts into the CSR matrix.
+    def _merge(self):
+        if not self._data: return
+        nfeats = len(self.feats)
+        nkeys = len(self.keys)
+        old = np.repeat(np.arange(len(self._indptr)-1), np.diff(self._indptr))
+        rows = np.concatenate((old, np.frombuffer(self._rows, dtype=np.int64)))
+        cols = np.concatenate(
+            (self._indices, np.frombuffer(self._cols, dtype=np.int64)))
+        data = np.concatenate(
+            (self._counts, np.frombuffer(self._data, dtype=np.int64)))
+        (cells, inv) = np.unique(rows*nkeys + cols, return_inverse=True)
+        counts = np.bincount(inv, weights=data,
+                             minlength=len(cells)).astype(np.int64)
+        assert (0 <= counts).all()
+        # Cells that are removed to zero are dropped.
+        nz = (counts != 0)
+        (cells, counts) = (cells[nz], counts[nz])
+        rows = cells // nkeys
+        self._indptr = np.zeros(nfeats+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=nfeats), out=self._indptr[1:])
+        self._indices = cells % nkeys
+        self._counts = counts
+        self._rows = array('q')
+        self._cols = array('q')
+        self._data = array('q')
+        self._logs = None
+        return
+
+    # _getrow: returns the key ids and counts of a feature.
+    def _getrow(self, fid):
+        (i0, i1) = (self._indptr[fid], self._indptr[fid+1])
+        return (self._indices[i0:i1], self._counts[i0:i1])
+
+    # _getlogs: returns log(count) for each cell and key.
+    #   math.log is used so that values are the same as NaiveBayes.
+    def _getlogs(self):
+        self._merge()
+        if self._logs is None:
+            self._logs = (
+                np.array([ math.log(c) for c in self._counts.tolist() ],
+                         dtype=np.float64),
+                np.array([ math.log(c) if 0 < c else 0.0
+                           for c in self.kcount ], dtype=np.float64))
+        return self._logs
+
+    def getkcount(self):
+        return { k:c for (k,c) in zip(self.keys, self.kcount) }
+
+    def getfcount(self, f):
+        self._merge()
+        (kids, counts) = self._getrow(self.fids[f])
+        return { self.keys[kid]: c
+                 for (kid,c) in zip(kids.tolist(), counts.tolist()) }
+
+    def getkeys(self, feats, n=0, fallback=False):
+        (logs, klogs) = self._getlogs()
+        valid = (0 < np.frombuffer(self.kcount, dtype=np.int64))
+        keyp = klogs.copy()
+        skipped = np.zeros(len(self.keys), dtype=bool)
+        for f in feats:
+            if f not in self.fids: continue
+            fid = self.fids[f]
+            (i0, i1) = (self._indptr[fid], self._indptr[fid+1])
+            kids = self._indices[i0:i1]
+            present = np.zeros(len(self.keys), dtype=bool)
+            present[kids] = True
+            keyp[kids] += logs[i0:i1] - klogs[kids]
+            if fallback:
+                keyp[~present] += -klogs[~present]
+            else:
+                skipped |= ~present
+        a = [ (p,self.keys[kid]) for (kid,p) in enumerate(keyp.tolist())
+              if valid[kid] and not skipped[kid] ]
+        if not a: return a
+        a.sort(reverse=True)
+        # prevent exp(x) overflow by adjusting the maximum log to zero.
+        m = max( p for (p,_) in a )
+        a = [ (p-m, k) for (p,k) in a ]
+        if n:
+            a = a[:n]
+        return a
+
+    def getkeyfeats(self, feats):
+        self._merge()
+        rows = [ (f, self._getrow(self.fids[f])) for f in feats
+                 if f in self.fids ]
+        hits = np.zeros(len(self.keys), dtype=np.int64)
+        for (_,(kids,_)) in rows:
+            hits[kids] += 1
+        if not rows or hits.max() == 0: return []
+        # keyp = { k1:[P(k), P(f1|k), P(f2|k), ...], k2:[ ... ] }
+        # only the keys that have the most features are taken.
+        keyp = { kid: [self.kcount[kid]]
+                 for kid in np.nonzero(hits == hits.max())[0].tolist() }
+        for (f,(kids,counts)) in rows:
+            for (kid,c) in zip(kids.tolist(), counts.tolist()):
+                if kid in keyp:
+                    keyp[kid].append((f, c))
+        # compute P(k) P(f1|k) P(f2|k) for each k.
+        keyfeats = []
+        for (kid,a) in keyp.items():
+            pk = p = math.log(a[0])
+            for (_,c) in a[1:]:
+                p += math.log(c) - pk
+            keyfeats.append((p, self.keys[kid], a))
+        keyfeats.sort(reverse=True)
+        # prevent exp(x) overflow by adjusting the maximum log to zero.
+        pm = max( p for (p,_,_) in keyfeats )
+        return [ (p-pm, k, a) for (p,k,a) in keyfeats ]
+
+##  MappedNaiveBayes
+##  Read-only NaiveBayes on a memory-mapped model file.
+##  The file consists of:
+##    MAP_MAGIC, nkeys, nfeats, ncells, len(keys) (uint64)
+##    keys (marshaled list, padded to 8 bytes)
+##    kcount (int64 x nkeys)
+##    feature name offsets (uint64 x nfeats+1)
+##    feature totals (int64 x nfeats)
+##    feature cell offsets (uint64 x nfeats+1)
+##    cell counts (int64 x ncells), cell key ids (uint32 x ncells)
+##    feature names (marshal version 0, which does not depend on
+##      interning, sorted)
+##  Only the keys are read when the file is opened.
+##
+MAP_MAGIC = b'NBAYES\x00\x02'
+
+class MappedCounts(Mapping):
+
+    """Lazy fcount of a MappedNaiveBayes."""
+
+    def __init__(self, mm, keys):
+        self.mm = mm
+        self.keys = keys
+        (nkeys, nfeats, ncells, n) = struct.unpack_from('<4Q', mm, len(MAP_MAGIC))
+        i = len(MAP_MAGIC)+32+n
+        buf = memoryview(mm)
+        def section(fmt, size, n):
+            nonlocal i
+            a = buf[i:i+size*n].cast(fmt)
+            i += size*n
+            return a
+        self.kcount = section('q', 8, nkeys)
+        self.foffs = section('Q', 8, nfeats+1)
+        self.ftotal = section('q', 8, nfeats)
+        self.indptr = section('Q', 8, nfeats+1)
+        self.counts = section('q', 8, ncells)
+        self.cellkeys = section('I', 4, ncells)
+        self.names = i
+        self.nfeats = nfeats
+        return
+
+    def __len__(self):
+        return self.nfeats
+
+    def _getname(self, i):
+        return self.mm[self.names+self.foffs[i]:self.names+self.foffs[i+1]]
+
+    # _find: returns the index of a feature by binary search, or -1.
+    def _find(self, f):
+        try:
+            name = marshal.dumps(f, 0)
+        except ValueError:
+            return -1
+        (i0, i1) = (0, self.nfeats)
+        while i0 < i1:
+            i = (i0+i1)//2
+            if self._getname(i) < name:
+                i0 = i+1
+            else:
+                i1 = i
+        if i0 < self.nfeats and self._getname(i0) == name:
+            return i0
+        return -1
+
+    def _getrow(self, i):
+        d = {None: self.ftotal[i]}
+        for j in range(self.indptr[i], self.indptr[i+1]):
+            d[self.keys[self.cellkeys[j]]] = self.counts[j]
+        return d
+
+    def __contains__(self, f):
+        return 0 <= self._find(f)
+
+    def __getitem__(self, f):
+        i = self._find(f)
+        if i < 0: raise KeyError(f)
+        return self._getrow(i)
+
+    def __iter__(self):
+        for i in range(self.nfeats):
+            yield marshal.loads(self._getname(i))
+        return
+
+    def items(self):
+        for i in range(self.nfeats):
+            yield (marshal.loads(self._getname(i)), self._getrow(i))
+        return
+
+    def release(self):
+        for a in (self.kcount, self.foffs, self.ftotal, self.indptr,
+                  self.counts, self.cellkeys):
+            a.release()
+        return
+
+class MappedNaiveBayes(NaiveBayes):
+
+    """
+>>> import tempfile
+>>> b = NaiveBayes()
+>>> b.add('banana', ['long','sweet','yellow'], 25)
+>>> b.add('orange', ['sweet','yellow'], 15)
+>>> b.add('other', ['sweet','long'], 5)
+>>> fp = tempfile.TemporaryFile()
+>>> b.savemap(fp)
+>>> fp.flush()
+>>> m = MappedNaiveBayes(fp)
+>>> m.kcount
+{'banana': 25, 'orange': 15, 'other': 5}
+>>> m.fcount['long']
+{None: 30, 'banana': 25, 'other': 5}
+>>> 'round' in m.fcount
+False
+>>> f = ''.join(['lo', 'ng'])
+>>> f in m.fcount
+True
+>>> m.getkeys(['long','sweet']) == b.getkeys(['long','sweet'])
+True
+>>> m.merge(b)
+Traceback (most recent call last):
+  ...
+TypeError: read-only model
+>>> m.close()
+"""
+
+    def __init__(self, fp):
+        NaiveBayes.__init__(self)
+        self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAP_MAGIC)] != MAP_MAGIC:
+            self.mm.close()
+            raise ValueError('not a model file')
+        (nkeys, _, _, n) = struct.unpack_from('<4Q', self.mm, len(MAP_MAGIC))
+        i = len(MAP_MAGIC)+32
+        keys = marshal.loads(self.mm[i:i+n])
+        self.fcount = MappedCounts(self.mm, keys)
+        self.kcount = dict(zip(keys, self.fcount.kcount))
+        return
+
+    def close(self):
+        self.fcount.release()
+        self.mm.close()
+        return
+
+    def adddict(self, key, count, feats):
+        raise TypeError('read-only model')
+
+    def removedict(self, key, count, feats):
+        raise TypeError('read-only model')
+
+    def merge(self, other):
+        raise TypeError('read-only model')
+
+    def load(self, fp):
+        raise TypeError('read-only model')
+
+    def compact(self, mincount=0, mingain=0.0):
+        raise TypeError('read-only model')
+
+# openmodel: opens a model file in either format.
+def openmodel(path):
+    fp = open(path, 'rb')
+    if fp.read(len(MAP_MAGIC)) == MAP_MAGIC:
+        with fp:
+            return MappedNaiveBayes(fp)
+    fp.seek(0)
+    with fp:
+        nb = NaiveBayes()
         nb.load(fp)
+    return nb
+
+##  Training
+##
+
+# parseline: returns (key, count, feats) from a line of a corpus.
+#   TSV: key, feature, feature, ...
+#   JSON: {"key": key, "feats": [feature, ...] or {feature: count, ...},
+#          "count": count}
+def parseline(line, fmt):
+    if fmt == 'tsv':
+        fields = line.rstrip('\n').split('\t')
+        return (fields[0], 1, { f:1 for f in fields[1:] if f })
+    obj = json.loads(line)
+    count = obj.get('count', 1)
+    feats = obj['feats']
+    if not isinstance(feats, dict):
+        feats = { f:count for f in feats }
+    return (obj['key'], count, feats)
+
+def getformat(path):
+    if path.endswith('.tsv'):
+        return 'tsv'
+    return 'json'
+
+# _trainrange: counts the lines that start in [start, end) of a file.
+def _trainrange(args):
+    (path, fmt, start, end) = args
+    nb = NaiveBayes()
+    with open(path, 'rb') as fp:
+        if 0 < start:
+            fp.seek(start-1)
+            start += len(fp.readline())-1
+        while start < end:
+            line = fp.readline()
+            if not line: break
+            start += len(line)
+            if not line.strip(): continue
+            (key, count, feats) = parseline(line.decode('utf-8'), fmt)
+            nb.adddict(key, count, feats)
+    return nb
+
+# train: builds a model from corpus files.
+#   Each file is cut into nworkers ranges that are counted in separate
+#   processes. The partial models are merged in file order, so the
+#   result is the same as training in one process.
+def train(paths, nworkers=1, fmt=None):
+    tasks = []
+    nb = NaiveBayes()
+    for path in paths:
+        fmt1 = fmt or getformat(path)
+        if path == '-':
+            for line in sys.stdin:
+                if not line.strip(): continue
+                nb.adddict(*parseline(line, fmt1))
+            continue
+        size = os.path.getsize(path)
+        n = max(1, nworkers)
+        for i in range(n):
+            tasks.append((path, fmt1, size*i//n, size*(i+1)//n))
+    if nworkers <= 1:
+        for task in tasks:
+            nb.merge(_trainrange(task))
+    else:
+        import multiprocessing
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(nworkers) as pool:
+            for part in pool.imap(_trainrange, tasks):
+                nb.merge(part)
+    return nb
+
+##  Benchmark
+##
+
+# gendocs: returns ndocs synthetic (key, feats) pairs.
+#   Keys and features follow Zipf distributions with exponent s.
+#   Each key has its own ranking of features.
+def gendocs(ndocs, nkeys, nfeats, docfeats=20, s=1.1, seed=0):
+    import random
+    from itertools import accumulate
+    r = random.Random(seed)
+    kweights = list(accumulate( 1/(i+1)**s for i in range(nkeys) ))
+    fweights = list(accumulate( 1/(i+1)**s for i in range(nfeats) ))
+    offsets = [ r.randrange(nfeats) for _ in range(nkeys) ]
+    docs = []
+    for _ in range(ndocs):
+        k = r.choices(range(nkeys), cum_weights=kweights)[0]
+        ranks = r.choices(range(nfeats), cum_weights=fweights, k=docfeats)
+        docs.append(('k%d' % k, set( 'f%d' % ((i+offsets[k]) % nfeats)
+                                     for i in ranks )))
+    return docs
+
+# benchmark: times training, queries and model files on synthetic data.
+#   Returns a report that can be saved as JSON.
+def benchmark(ndocs=100000, nkeys=100, nfeats=10000, docfeats=20,
+              nqueries=1000, seed=0):
+    import time
+    import tempfile
+    import tracemalloc
+    docs = gendocs(ndocs+nqueries, nkeys, nfeats, docfeats, seed=seed)
+    queries = [ sorted(feats) for (_,feats) in docs[ndocs:] ]
+    docs = docs[:ndocs]
+    results = {}
+    def timeit(name, n, func):
+        t0 = time.perf_counter()
+        v = func()
+        dt = time.perf_counter() - t0
+        results[name] = {'n': n, 'seconds': dt, 'persec': n/dt if dt else 0}
+        return v
+    def add():
+        nb = NaiveBayes()
+        for (k,feats) in docs:
+            nb.add(k, feats)
+        return nb
+    nb = timeit('add', ndocs, add)
+    timeit('getkeys', nqueries,
+           lambda: [ nb.getkeys(q, 10) for q in queries ])
+    timeit('getkeys_many', nqueries, lambda: nb.getkeys_many(queries, 10))
+    timeit('getkeyfeats', nqueries,
+           lambda: [ nb.getkeyfeats(q) for q in queries ])
+    timeit('narrow', nqueries, lambda: [ nb.narrow(q, 0.5) for q in queries ])
+    memory = {'getsize': nb.getsize()}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'model')
+        with open(path, 'wb') as fp:
+            timeit('save', 1, lambda: nb.save(fp))
+        memory['file'] = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            timeit('load', 1, lambda: NaiveBayes().load(fp))
+        with open(path, 'rb') as fp:
+            tracemalloc.start()
+            nb1 = NaiveBayes()
+            nb1.load(fp)
+            memory['loaded'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del nb1
+        with open(path, 'wb') as fp:
+            timeit('savemap', 1, lambda: nb.savemap(fp))
+        memory['mapfile'] = os.path.getsize(path)
+        nb1 = timeit('openmap', 1, lambda: openmodel(path))
+        timeit('mapped_getkeys', nqueries,
+               lambda: [ nb1.getkeys(q, 10) for q in queries ])
+        nb1.close()
+    return {
+        'python': sys.version.split()[0],
+        'numpy': np.__version__ if np is not None else None,
+        'params': {'ndocs': ndocs, 'nkeys': nkeys, 'nfeats': nfeats,
+                   'docfeats': docfeats, 'nqueries': nqueries, 'seed': seed},
+        'results': results,
+        'memory': memory,
+    }
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print('usage: %s [-j nworkers] [-t tsv|json] [-c mincount] '
+              '[-g mingain] [-M] -o model [corpus ...]' % argv[0])
+        print('       %s -B ndocs [-K nkeys] [-F nfeats]' % argv[0])
+        print('       %s model' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'j:t:c:g:Mo:B:K:F:')
+    except getopt.GetoptError:
+        return usage()
+    nworkers = 1
+    fmt = None
+    mincount = 0
+    mingain = 0.0
+    mapped = False
+    output = None
+    ndocs = 0
+    nkeys = 100
+    nfeats = 10000
+    for (k, v) in opts:
+        if k == '-j': nworkers = int(v)
+        elif k == '-t': fmt = v
+        elif k == '-c': mincount = int(v)
+        elif k == '-g': mingain = float(v)
+        elif k == '-M': mapped = True
+        elif k == '-o': output = v
+        elif k == '-B': ndocs = int(v)
+        elif k == '-K': nkeys = int(v)
+        elif k == '-F': nfeats = int(v)
+    if ndocs:
+        report = benchmark(ndocs, nkeys=nkeys, nfeats=nfeats)
+        print(json.dumps(report, indent=1))
+        return 0
+    if output is not None:
+        nb = train(args or ['-'], nworkers=nworkers, fmt=fmt)
+        if mincount or mingain:
+            (nfeats, ncells, size0, size1) = nb.compact(mincount, mingain)
+            print('compact: removed %d features, %d cells, %d -> %d bytes' %
+                  (nfeats, ncells, size0, size1), file=sys.stderr)
+        with open(output, 'wb') as fp:
+            if mapped:
+                nb.savemap(fp)
+            else:
+                nb.save(fp)
+        return 0
+    if not args: return usage()
+    nb = openmodel(args[0])
     nb.dump()
     return 0
 if __name__ == '__main__': sys.exit(main(sys.argv))
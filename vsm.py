@@ -6,6 +6,47 @@
 ##
 import sys
 import math
+import mmap
+import heapq
+import struct
+import marshal
+import hashlib
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+##  IDF
+##  Read-only view of the current IDF of each term.
+##  IDF of terms that appear in one document or none is idf[None].
+##
+class IDF:
+
+    def __init__(self, vsm):
+        self.vsm = vsm
+        return
+
+    def __getitem__(self, k):
+        n = math.log(len(self.vsm.docs))
+        if k is None: return n
+        return n - self.vsm.logdf[k]
+
+    def __contains__(self, k):
+        return k is None or k in self.vsm.logdf
+
+    def get(self, k, default=None):
+        if k not in self: return default
+        return self[k]
+
+# dotsim: returns the cosine of two weighted vectors.
+def dotsim(f1, n1, f2, n2):
+    if n1 == 0 or n2 == 0: return 0
+    dot = sum( v1*f2[k] for (k,v1) in f1.items() if k in f2 )
+    return dot/math.sqrt(n1*n2)
 
 class VSM:
 
@@ -18,19 +59,63 @@ class VSM:
 0
 >>> list(sp.findsim('A'))
 [(0, 'B')]
+>>> sp.add('C', {'foo':1, 'qux':1})
+>>> [ (round(sim, 6), k) for (sim,k) in sp.findsim('A') ]
+[(0.866025, 'B'), (0.141353, 'C')]
+>>> [ (round(sim, 6), k0, k1) for (sim,k0,k1) in sp.findall(threshold=0.5) ]
+[(0.866025, 'A', 'B')]
+>>> sp.remove('B')
+>>> list(sp.findsim('A'))
+[(0.0, 'C')]
+>>> sp.add('B', {'foo':1})
+>>> sp.add('B', {'baa':1})
+>>> sorted(sp.df.items())
+[('baa', 2), ('baz', 1), ('foo', 2), ('qux', 1)]
+>>> sp.remove('B')
+>>> sp.docsim('A', 'C') == sp.calcsim(sp.get('A'), sp.get('C'))
+True
+>>> [ (round(sim, 6), k) for (sim,k) in sp.query({'baz':1}, 0.5) ]
+[(0.894427, 'A')]
+>>> list(sp.topk_all(1))
+[('A', [(0.0, 'C')]), ('C', [(0.0, 'A')])]
 """
 
+    prune = 0.5
+
     def __init__(self):
         self.tf = {}
         self.df = {}
-        self.idf = None
+        self.logdf = {}
+        self.idf = IDF(self)
         self.docs = {}
+        self.version = 0
+        # vecs = { key: (version, weighted feats, squared norm) }
+        self.vecs = {}
+        # items = [(key, feats) or None, ...]
+        # postings = { term: ([doc id, ...], [tf, ...]) }
+        self.ids = {}
+        self.index = ([], {})
+        self.nremoved = 0
+        # maxw = { term: max |weight|/norm } at maxwversion
+        self.maxw = {}
+        self.maxwversion = None
         return
 
     def __len__(self):
         return len(self.docs)
 
+    # _setdf: updates the log df of a term.
+    def _setdf(self, k, v):
+        if 1 < v:
+            self.logdf[k] = math.log(v)
+        elif k in self.logdf:
+            del self.logdf[k]
+        return
+
     def add(self, key, feats):
+        if key in self.docs:
+            # the old document is replaced in its place.
+            self._uncount(self.docs[key])
         a = set()
         for (k,v) in feats.items():
             if k not in self.tf:
@@ -41,51 +126,944 @@ class VSM:
             if k not in self.df:
                 self.df[k] = 0
             self.df[k] += 1
+            self._setdf(k, self.df[k])
+        (items, postings) = self.index
+        if key in self.ids:
+            i = self.ids[key]
+            self._unpost(i)
+            items[i] = (key, feats)
+        else:
+            i = self.ids[key] = len(items)
+            items.append((key, feats))
+        for (k,v) in feats.items():
+            if k in postings:
+                (ids, vals) = postings[k]
+            else:
+                (ids, vals) = postings[k] = ([], [])
+            if ids and i < ids[-1]:
+                p = bisect_left(ids, i)
+                ids.insert(p, i)
+                vals.insert(p, v)
+            else:
+                ids.append(i)
+                vals.append(v)
         self.docs[key] = feats
-        self.idf = None
+        self.version += 1
+        return
+
+    def remove(self, key):
+        self._uncount(self.docs.pop(key))
+        self.vecs.pop(key, None)
+        i = self.ids.pop(key)
+        self._unpost(i)
+        self.index[0][i] = None
+        self.nremoved += 1
+        if len(self.docs) < self.nremoved:
+            self._compact()
+        self.version += 1
+        return
+
+    # _compact: renumbers the documents to reclaim the removed ones.
+    #   The order of the documents is kept.
+    def _compact(self):
+        (items, postings) = self.index
+        newids = {}
+        for (i,item) in enumerate(items):
+            if item is None: continue
+            newids[i] = len(newids)
+        items[:] = [ item for item in items if item is not None ]
+        for (ids, _) in postings.values():
+            ids[:] = [ newids[j] for j in ids ]
+        self.ids = { key: i for (i,(key,_)) in enumerate(items) }
+        self.nremoved = 0
+        return
+
+    # _uncount: subtracts the tf and df of a document.
+    def _uncount(self, feats):
+        for (k,v) in feats.items():
+            self.tf[k] -= v
+        for k in set(feats.keys()):
+            self.df[k] -= 1
+            self._setdf(k, self.df[k])
+            if self.df[k] == 0:
+                del self.df[k]
+        return
+
+    # _unpost: removes a document from the postings.
+    def _unpost(self, i):
+        (items, postings) = self.index
+        for k in items[i][1].keys():
+            (ids, vals) = postings[k]
+            p = bisect_left(ids, i)
+            del ids[p]
+            del vals[p]
+            if not ids:
+                del postings[k]
         return
 
     def get(self, key):
         return self.docs[key]
 
+    # commit: computes the weighted vectors of new documents.
+    #   IDF and the index are kept up to date by add/remove.
     def commit(self):
-        if self.idf is None:
+        for key in self.docs:
+            if key not in self.vecs:
+                self.getvec(key)
+        return
+
+    # getvec: returns the weighted vector and the squared norm of a
+    #   document. Every add/remove changes IDF, so the vectors that
+    #   are older are computed again when needed.
+    def getvec(self, key):
+        v = self.vecs.get(key)
+        if v is None or v[0] != self.version:
+            f = self.weight(self.docs[key])
+            v = self.vecs[key] = (self.version, f,
+                                  sum( w*w for w in f.values() ))
+        return (v[1], v[2])
+
+    # getnorm: returns the squared norm of a document.
+    def getnorm(self, key):
+        return self.getvec(key)[1]
+
+    # getmaxw: returns the largest |weight|/norm of each term in the
+    #   documents. Every add/remove changes the weights, so it is
+    #   computed again when needed and search() uses it until then.
+    def getmaxw(self):
+        if self.maxwversion != self.version:
+            maxw = {}
+            for key in self.docs:
+                (f, n) = self.getvec(key)
+                if n == 0: continue
+                n = math.sqrt(n)
+                for (k,v) in f.items():
+                    maxw[k] = max(maxw.get(k, 0), abs(v)/n)
+            self.maxw = maxw
+            self.maxwversion = self.version
+        return self.maxw
+
+    def weight(self, feats):
+        n = math.log(len(self.docs))
+        logdf = self.logdf
+        return { k: v*((n - logdf[k]) if k in logdf else n)
+                 for (k,v) in feats.items() }
+
+    # getmatrix: returns the normalized TF-IDF vectors of all documents
+    #   as a sparse matrix, and the column of each term.
+    def getmatrix(self):
+        terms = {}
+        (indptr, indices, data) = ([0], [], [])
+        for key in self.docs:
+            (f, n) = self.getvec(key)
+            n = math.sqrt(n)
+            for (k,v) in f.items():
+                if n == 0 or v == 0: continue
+                if k not in terms:
+                    terms[k] = len(terms)
+                indices.append(terms[k])
+                data.append(v/n)
+            indptr.append(len(indices))
+        mat = (np.array(indptr, dtype=np.int64),
+               np.array(indices, dtype=np.int64),
+               np.array(data, dtype=np.float64))
+        return (mat, terms)
+
+    # getindex: returns an inverted index of some documents.
+    def getindex(self, items):
+        postings = {}
+        for (i,(_,feats)) in enumerate(items):
+            for (k,v) in feats.items():
+                if k in postings:
+                    (ids, vals) = postings[k]
+                else:
+                    (ids, vals) = postings[k] = ([], [])
+                ids.append(i)
+                vals.append(v)
+        return (items, postings)
+
+    # search: yields (doc id, sim) for the documents from start
+    #   in the index that are similar to a weighted vector f0.
+    #   For thresholds from self.prune, only the documents that share
+    #   the terms with the largest weights are compared.
+    def search(self, index, f0, n0, start=0, threshold=0):
+        (items, postings) = index
+        if threshold < self.prune:
+            # accumulate the dot products in the order calcsim does.
             n = math.log(len(self.docs))
-            self.idf = {None: n}
-            for (k,v) in self.df.items():
-                if v <= 1: continue
-                self.idf[k] = n - math.log(v)
+            dots = {}
+            for (k,v0) in f0.items():
+                if k not in postings: continue
+                idf = (n - self.logdf[k]) if k in self.logdf else n
+                (ids, vals) = postings[k]
+                for p in range(bisect_left(ids, start), len(ids)):
+                    j = ids[p]
+                    dots[j] = dots.get(j, 0) + v0*(vals[p]*idf)
+            if 0 < threshold:
+                # documents without common terms are 0.
+                ids = sorted(dots)
+            else:
+                ids = ( j for j in range(start, len(items))
+                        if items[j] is not None )
+            for j in ids:
+                n1 = self.getnorm(items[j][0])
+                if n0 == 0 or n1 == 0:
+                    sim = 0
+                else:
+                    sim = dots.get(j, 0)/math.sqrt(n0*n1)
+                if sim < threshold: continue
+                yield (j, sim)
+            return
+        if n0 == 0: return
+        # take the terms with the largest weights first.
+        # the documents that have none of them cannot reach threshold:
+        # their similarity is at most both the sum of the rest weights
+        # times maxw (if it is current) and the norm of the rest weights.
+        maxw = self.maxw if self.maxwversion == self.version else {}
+        terms = sorted(( (v0*v0/n0, k) for (k,v0) in f0.items()
+                         if k in postings ), reverse=True)
+        rest1 = sum( math.sqrt(w)*maxw.get(k, 1) for (w,k) in terms )
+        rest2 = sum( w for (w,_) in terms )
+        cands = set()
+        for (w,k) in terms:
+            if min(rest1, math.sqrt(max(0, rest2))) < threshold*(1-1e-9): break
+            (ids, _) = postings[k]
+            cands.update(ids[bisect_left(ids, start):])
+            rest1 -= math.sqrt(w)*maxw.get(k, 1)
+            rest2 -= w
+        for j in sorted(cands):
+            (f1, n1) = self.getvec(items[j][0])
+            if n1 == 0: continue
+            dot = sum( v0*f1[k] for (k,v0) in f0.items() if k in f1 )
+            sim = dot/math.sqrt(n0*n1)
+            if sim < threshold: continue
+            yield (j, sim)
         return
 
     def calcsim(self, feats1, feats2):
-        assert self.idf is not None
-        D = self.idf[None]
-        f1 = { k: v*self.idf.get(k,D) for (k,v) in feats1.items() }
-        f2 = { k: v*self.idf.get(k,D) for (k,v) in feats2.items() }
+        f1 = self.weight(feats1)
+        f2 = self.weight(feats2)
         n1 = sum( v*v for v in f1.values() )
         n2 = sum( v*v for v in f2.values() )
-        if n1 == 0 or n2 == 0: return 0
-        dot = sum( v1*f2[k] for (k,v1) in f1.items() if k in f2 )
-        return dot/math.sqrt(n1*n2)
+        return dotsim(f1, n1, f2, n2)
+
+    # docsim: calcsim() of two documents with their stored vectors.
+    def docsim(self, k1, k2):
+        return dotsim(*(self.getvec(k1) + self.getvec(k2)))
+
+    def findsim(self, k0, threshold=0):
+        items = self.index[0]
+        i0 = self.ids[k0]
+        (f0, n0) = self.getvec(k0)
+        for (j,sim) in self.search(self.index, f0, n0, 0, threshold):
+            if j == i0: continue
+            yield (sim, items[j][0])
+        return
+
+    # query: yields (sim, key) for the documents similar to feats.
+    def query(self, feats, threshold=0):
+        items = self.index[0]
+        f0 = self.weight(feats)
+        n0 = sum( v*v for v in f0.values() )
+        for (j,sim) in self.search(self.index, f0, n0, 0, threshold):
+            yield (sim, items[j][0])
+        return
+
+    def findall(self, keys=None, threshold=0, verbose=False):
+        if keys is None:
+            index = self.index
+            if self.prune <= threshold:
+                self.getmaxw()
+        else:
+            index = self.getindex([ (k,self.docs[k]) for k in keys ])
+        items = index[0]
+        for (i,item) in enumerate(items):
+            if item is None: continue
+            k0 = item[0]
+            (f0, n0) = self.getvec(k0)
+            for (j,sim) in self.search(index, f0, n0, i+1, threshold):
+                yield (sim, k0, items[j][0])
+            if verbose:
+                sys.stderr.write('.'); sys.stderr.flush()
+        return
+
+    def _nrows(self):
+        return len(self.index[0])
+
+    # savemap: writes the model in the format read by MappedVSM.
+    def savemap(self, fp):
+        (_, postings) = self.index
+        keys = list(self.docs.keys())
+        newids = { self.ids[k]:i for (i,k) in enumerate(keys) }
+        # terms are sorted by their marshaled names for binary search.
+        terms = sorted( (marshal.dumps(t, 0), t)
+                        for t in set(postings).union(self.df) )
+        tids = { t:i for (i,(_,t)) in enumerate(terms) }
+        (df, logdf, tindptr) = (array('q'), array('d'), array('Q', [0]))
+        (tdocs, ttf) = (array('I'), array('d'))
+        for (_,t) in terms:
+            df.append(self.df.get(t, 0))
+            logdf.append(self.logdf.get(t, 0.0))
+            (ids, vals) = postings.get(t, ((), ()))
+            tdocs.extend( newids[i] for i in ids )
+            ttf.extend(vals)
+            tindptr.append(len(tdocs))
+        (norms, dindptr) = (array('d'), array('Q', [0]))
+        (dterms, dtf) = (array('I'), array('d'))
+        for k in keys:
+            norms.append(self.getvec(k)[1])
+            for (t,v) in self.docs[k].items():
+                dterms.append(tids[t])
+                dtf.append(v)
+            dindptr.append(len(dterms))
+        knames = [ marshal.dumps(k, 0) for k in keys ]
+        korder = array('Q', sorted(range(len(keys)), key=knames.__getitem__))
+        (toffs, koffs) = (array('Q', [0]), array('Q', [0]))
+        for (name,_) in terms:
+            toffs.append(toffs[-1]+len(name))
+        for name in knames:
+            koffs.append(koffs[-1]+len(name))
+        assert sys.byteorder == 'little'
+        fp.write(VSM_MAGIC)
+        fp.write(struct.pack('<3Q', len(keys), len(terms), len(tdocs)))
+        for a in (df, logdf, toffs, tindptr, tdocs, ttf,
+                  norms, dindptr, dterms, dtf, koffs, korder):
+            a.tofile(fp)
+            if a.itemsize*len(a) % 8:
+                fp.write(bytes(4))
+        for (name,_) in terms:
+            fp.write(name)
+        for name in knames:
+            fp.write(name)
+        return
+
+    # topkblock: returns (key, [(sim, key1), ...]) of the documents in
+    #   rows [i0,i1) with their k most similar documents.
+    def topkblock(self, i0, i1, k, threshold=0):
+        items = self.index[0]
+        results = []
+        for i in range(i0, i1):
+            if items[i] is None: continue
+            k0 = items[i][0]
+            (f0, n0) = self.getvec(k0)
+            heap = []
+            for (j,sim) in self.search(self.index, f0, n0, 0, threshold):
+                if j == i: continue
+                # ties are broken by the document order.
+                if len(heap) < k:
+                    heapq.heappush(heap, (sim, -j))
+                elif heap[0] < (sim, -j):
+                    heapq.heapreplace(heap, (sim, -j))
+            heap.sort(reverse=True)
+            results.append((k0, [ (sim, items[-nj][0]) for (sim,nj) in heap ]))
+        return results
+
+    # topk_all: yields (key, [(sim, key1), ...]) for every document
+    #   with its k most similar documents from threshold, in order.
+    #   Blocks of rows are scored in nworkers forked processes, which
+    #   inherit a copy-on-write image of this model. Pages of Python
+    #   objects are copied as their refcounts change; only untouched
+    #   NumPy buffers stay physically shared.
+    #   progress(ndone, ntotal) is called after each block.
+    def topk_all(self, k=10, threshold=0, nworkers=1, blocksize=256,
+                 progress=None):
+        self.commit()
+        # bring all vectors up to date before forking.
+        for key in self.docs:
+            self.getvec(key)
+        if self.prune <= threshold:
+            self.getmaxw()
+        n = self._nrows()
+        tasks = [ (i0, min(n, i0+blocksize), k, threshold)
+                  for i0 in range(0, n, blocksize) ]
+        if nworkers < 2:
+            for (i,args) in enumerate(tasks):
+                yield from self.topkblock(*args)
+                if progress is not None:
+                    progress(i+1, len(tasks))
+            return
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(nworkers, _setworker, (self,)) as pool:
+            results = pool.imap(_topkblock, tasks)
+            for (i,block) in enumerate(results):
+                yield from block
+                if progress is not None:
+                    progress(i+1, len(tasks))
+        return
+
+# _setworker: sets the model of a forked worker.
+def _setworker(vsm):
+    global _worker
+    _worker = vsm
+    return
+
+def _topkblock(args):
+    return _worker.topkblock(*args)
+_worker = None
+
+# progressbar: reports the progress of topk_all() to stderr.
+def progressbar(ndone, ntotal):
+    sys.stderr.write('\r%d/%d blocks (%d%%)' % (ndone, ntotal, 100*ndone//ntotal))
+    if ndone == ntotal:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+    return
+
+
+##  MappedVSM
+##  Read-only VSM on a memory-mapped model file.
+##  The file consists of:
+##    VSM_MAGIC, ndocs, nterms, nnz (uint64)
+##    df (int64 x nterms), log df (float64 x nterms)
+##    term name offsets (uint64 x nterms+1)
+##    postings: offsets (uint64 x nterms+1), doc ids (uint32 x nnz),
+##      tf (float64 x nnz)
+##    squared norms (float64 x ndocs)
+##    documents: offsets (uint64 x ndocs+1), term ids (uint32 x nnz),
+##      tf (float64 x nnz)
+##    key name offsets (uint64 x ndocs+1), doc ids by key (uint64 x ndocs)
+##    term names, keys (marshal version 0, which does not depend on
+##      interning)
+##  uint32 arrays are padded to 8 bytes. Term frequencies are read
+##  back as floats.
+##
+VSM_MAGIC = b'VSMODEL\x01'
+
+# NameTable: marshaled names in a buffer found by binary search.
+class NameTable:
+
+    def __init__(self, buf, offs, base, order=None):
+        self.buf = buf
+        self.offs = offs
+        self.base = base
+        self.order = order
+        return
+
+    def __len__(self):
+        return len(self.offs)-1
+
+    def getbytes(self, i):
+        return self.buf[self.base+self.offs[i]:self.base+self.offs[i+1]]
+
+    def getname(self, i):
+        return marshal.loads(self.getbytes(i))
+
+    # find: returns the index of a name, or -1.
+    def find(self, name):
+        try:
+            name = marshal.dumps(name, 0)
+        except ValueError:
+            return -1
+        order = self.order
+        (i0, i1) = (0, len(self))
+        while i0 < i1:
+            i = (i0+i1)//2
+            if self.getbytes(order[i] if order else i) < name:
+                i0 = i+1
+            else:
+                i1 = i
+        if i0 == len(self): return -1
+        i = order[i0] if order else i0
+        return i if self.getbytes(i) == name else -1
+
+# MappedTerms: name -> func(index) for the names in a table.
+#   Names where func returns None are not included.
+class MappedTerms(Mapping):
+
+    def __init__(self, table, func, alldefined=False):
+        self.table = table
+        self.func = func
+        self.alldefined = alldefined
+        return
+
+    def __len__(self):
+        if self.alldefined:
+            return len(self.table)
+        return sum( 1 for i in range(len(self.table))
+                    if self.func(i) is not None )
+
+    def __iter__(self):
+        for i in range(len(self.table)):
+            if self.func(i) is None: continue
+            yield self.table.getname(i)
+        return
+
+    def __getitem__(self, t):
+        i = self.table.find(t)
+        v = None if i < 0 else self.func(i)
+        if v is None: raise KeyError(t)
+        return v
+
+    def __contains__(self, t):
+        i = self.table.find(t)
+        return 0 <= i and self.func(i) is not None
+
+# MappedItems: the (key, None) of each document id.
+#   The features are taken from MappedVSM.docs.
+class MappedItems:
+
+    def __init__(self, keys):
+        self.keys = keys
+        return
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        if not (0 <= i < len(self.keys)): raise IndexError(i)
+        return (self.keys.getname(i), None)
+
+class MappedVSM(VSM):
+
+    """
+>>> import tempfile
+>>> sp = VSM()
+>>> sp.add('A', {'foo':1, 'baa':1, 'baz':2})
+>>> sp.add('B', {'baa':1, 'baz':1})
+>>> sp.add('C', {'foo':1, 'qux':1})
+>>> fp = tempfile.TemporaryFile()
+>>> sp.savemap(fp)
+>>> fp.flush()
+>>> m = MappedVSM(fp)
+>>> m.get('C')
+{'foo': 1.0, 'qux': 1.0}
+>>> list(m.findsim('A')) == list(sp.findsim('A'))
+True
+>>> list(m.findall(threshold=0.1)) == list(sp.findall(threshold=0.1))
+True
+>>> m.close()
+"""
+
+    def __init__(self, fp):
+        VSM.__init__(self)
+        self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(VSM_MAGIC)] != VSM_MAGIC:
+            self.mm.close()
+            raise ValueError('not a model file')
+        (ndocs, nterms, nnz) = struct.unpack_from('<3Q', self.mm,
+                                                  len(VSM_MAGIC))
+        self.buf = memoryview(self.mm)
+        self.views = []
+        i = len(VSM_MAGIC)+24
+        def section(fmt, n):
+            nonlocal i
+            size = struct.calcsize(fmt)*n
+            a = self.buf[i:i+size].cast(fmt)
+            self.views.append(a)
+            i += size + (-size % 8)
+            return a
+        df = section('q', nterms)
+        logdf = section('d', nterms)
+        toffs = section('Q', nterms+1)
+        tindptr = section('Q', nterms+1)
+        tdocs = section('I', nnz)
+        ttf = section('d', nnz)
+        self.norms = section('d', ndocs)
+        dindptr = section('Q', ndocs+1)
+        dterms = section('I', nnz)
+        dtf = section('d', nnz)
+        koffs = section('Q', ndocs+1)
+        korder = section('Q', ndocs)
+        terms = NameTable(self.mm, toffs, i)
+        keys = NameTable(self.mm, koffs, i+toffs[-1], korder)
+        def getdoc(i):
+            (j0, j1) = (dindptr[i], dindptr[i+1])
+            return { terms.getname(t): v for (t,v)
+                     in zip(dterms[j0:j1], dtf[j0:j1]) }
+        self.df = MappedTerms(terms, lambda i: df[i] if df[i] else None)
+        self.logdf = MappedTerms(terms, lambda i: logdf[i] if 1 < df[i] else None)
+        self.ids = MappedTerms(keys, lambda i: i, True)
+        self.docs = MappedTerms(keys, getdoc, True)
+        postings = MappedTerms(terms, lambda i: (
+            tdocs[tindptr[i]:tindptr[i+1]], ttf[tindptr[i]:tindptr[i+1]])
+                               if tindptr[i] < tindptr[i+1] else None)
+        self.index = (MappedItems(keys), postings)
+        self.tf = None
+        return
+
+    def close(self):
+        for a in self.views:
+            a.release()
+        self.buf.release()
+        self.mm.close()
+        return
+
+    def add(self, key, feats):
+        raise TypeError('read-only model')
+
+    def remove(self, key):
+        raise TypeError('read-only model')
+
+    # commit: the vectors are computed when needed.
+    def commit(self):
+        return
+
+    # getvec: the vectors are not kept, so that the processes
+    #   share the model only through the mapped file.
+    def getvec(self, key):
+        return (self.weight(self.docs[key]), self.getnorm(key))
+
+    def getnorm(self, key):
+        return self.norms[self.ids[key]]
+
+
+##  Sparse matrices
+##  A matrix is a tuple (indptr, indices, data) of NumPy arrays.
+##
+
+# transpose: returns the transposed matrix of a matrix with ncols columns.
+def transpose(mat, ncols):
+    (indptr, indices, data) = mat
+    rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    tindptr = np.zeros(ncols+1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=ncols), out=tindptr[1:])
+    return (tindptr, rows[order], data[order])
+
+# getrows: returns a matrix of the given rows.
+def getrows(mat, rows):
+    (indptr, indices, data) = mat
+    rows = np.asarray(rows, dtype=np.int64)
+    lens = indptr[rows+1] - indptr[rows]
+    pos = np.repeat(indptr[rows] - np.cumsum(lens) + lens, lens)
+    pos += np.arange(len(pos))
+    newptr = np.zeros(len(rows)+1, dtype=np.int64)
+    np.cumsum(lens, out=newptr[1:])
+    return (newptr, indices[pos], data[pos])
+
+# blockdot: returns the dense product of rows [i0,i1) of mat and
+#   the transposed matrix tmat with ncols columns.
+def blockdot(mat, i0, i1, tmat, ncols):
+    (indptr, indices, data) = mat
+    (tindptr, tindices, tdata) = tmat
+    (j0, j1) = (indptr[i0], indptr[i1])
+    terms = indices[j0:j1]
+    lens = tindptr[terms+1] - tindptr[terms]
+    pos = np.repeat(tindptr[terms] - np.cumsum(lens) + lens, lens)
+    pos += np.arange(len(pos))
+    rows = np.repeat(np.repeat(np.arange(i1-i0), np.diff(indptr[i0:i1+1])),
+                     lens)
+    vals = np.repeat(data[j0:j1], lens) * tdata[pos]
+    sims = np.bincount(rows*ncols + tindices[pos], weights=vals,
+                       minlength=(i1-i0)*ncols)
+    return sims.reshape(i1-i0, ncols)
+
+# getblocks: splits rows into blocks whose product has about maxcells
+#   cells and intermediate values.
+def getblocks(mat, tmat, ncols, maxcells):
+    (indptr, indices, _) = mat
+    (tindptr, _, _) = tmat
+    nrows = len(indptr)-1
+    rows = np.repeat(np.arange(nrows), np.diff(indptr))
+    lens = (tindptr[indices+1] - tindptr[indices]).astype(np.float64)
+    cost = np.cumsum(ncols + np.bincount(rows, weights=lens, minlength=nrows))
+    i0 = 0
+    while i0 < nrows:
+        base = cost[i0-1] if i0 else 0
+        i1 = max(i0+1, int(np.searchsorted(cost, base+maxcells, 'right')))
+        yield (i0, i1)
+        i0 = i1
+    return
+
+
+##  SparseVSM
+##  VSM that keeps normalized TF-IDF vectors as a sparse matrix.
+##
+class SparseVSM(VSM):
+
+    """
+>>> sp = SparseVSM()
+>>> sp.add('A', {'foo':1, 'baa':1, 'baz':2})
+>>> sp.add('B', {'baa':1, 'baz':1})
+>>> sp.add('C', {'foo':1, 'baz':1})
+>>> sp.commit()
+>>> [ (round(sim, 6), k) for (sim,k) in sp.findsim('A') ]
+[(0.707107, 'B'), (0.707107, 'C')]
+>>> [ (round(sim, 6), k0, k1) for (sim,k0,k1) in sp.findall(threshold=0.1) ]
+[(0.707107, 'A', 'B'), (0.707107, 'A', 'C')]
+>>> list(sp.findall(['B','C']))
+[(0.0, 'B', 'C')]
+>>> [ (k, [ k1 for (_,k1) in a ]) for (k,a) in sp.topk_all(1) ]
+[('A', ['B']), ('B', ['A']), ('C', ['A'])]
+"""
+
+    def __init__(self, maxcells=1<<22):
+        if np is None:
+            raise ImportError('SparseVSM requires numpy')
+        VSM.__init__(self)
+        self.maxcells = maxcells
+        self.keys = None
+        self.kids = None
+        self.mat = None
+        self.tmat = None
+        return
+
+    def add(self, key, feats):
+        VSM.add(self, key, feats)
+        self.mat = None
+        return
+
+    def remove(self, key):
+        VSM.remove(self, key)
+        self.mat = None
+        return
+
+    def commit(self):
+        if self.mat is not None: return
+        self.keys = list(self.docs.keys())
+        self.kids = { k:i for (i,k) in enumerate(self.keys) }
+        (self.mat, terms) = self.getmatrix()
+        self.tmat = transpose(self.mat, len(terms))
+        return
+
+    def findsim(self, k0, threshold=0):
+        assert self.mat is not None
+        i0 = self.kids[k0]
+        sims = blockdot(self.mat, i0, i0+1, self.tmat, len(self.keys))[0]
+        if 0 < threshold:
+            ids = np.nonzero(threshold <= sims)[0]
+        else:
+            ids = np.arange(len(self.keys))
+        for (i,sim) in zip(ids.tolist(), sims[ids].tolist()):
+            if i == i0: continue
+            yield (sim, self.keys[i])
+        return
+
+    def _nrows(self):
+        return len(self.keys)
+
+    def topkblock(self, i0, i1, k, threshold=0):
+        assert self.mat is not None
+        sims = blockdot(self.mat, i0, i1, self.tmat, len(self.keys))
+        sims[np.arange(i1-i0), np.arange(i0, i1)] = -np.inf
+        results = []
+        for (i,row) in enumerate(sims):
+            if 0 < threshold:
+                ids = np.nonzero(threshold <= row)[0]
+            else:
+                ids = np.nonzero(-np.inf < row)[0]
+            if k < len(ids):
+                m = np.partition(row[ids], len(ids)-k)[len(ids)-k]
+                ids = ids[m <= row[ids]]
+            # ties are broken by the document order.
+            ids = ids[np.lexsort((ids, -row[ids]))][:k]
+            results.append((self.keys[i0+i],
+                            [ (sim, self.keys[j]) for (sim,j)
+                              in zip(row[ids].tolist(), ids.tolist()) ]))
+        return results
+
+    def findall(self, keys=None, threshold=0, verbose=False):
+        assert self.mat is not None
+        if keys is None:
+            keys = self.keys
+            mat = self.mat
+            tmat = self.tmat
+        else:
+            keys = list(keys)
+            mat = getrows(self.mat, [ self.kids[k] for k in keys ])
+            tmat = transpose(mat, len(self.tmat[0])-1)
+        n = len(keys)
+        for (i0,i1) in getblocks(mat, tmat, n, self.maxcells):
+            sims = blockdot(mat, i0, i1, tmat, n)
+            for i in range(i0, i1):
+                row = sims[i-i0, i+1:]
+                if 0 < threshold:
+                    ids = np.nonzero(threshold <= row)[0]
+                else:
+                    ids = np.arange(len(row))
+                k0 = keys[i]
+                for (j,sim) in zip(ids.tolist(), row[ids].tolist()):
+                    yield (sim, k0, keys[i+1+j])
+                if verbose:
+                    sys.stderr.write('.'); sys.stderr.flush()
+        return
+
+
+##  LSH
+##  Signatures are computed from 64-bit term hashes with SplitMix64.
+##
+
+# termhash: returns a 64-bit hash of a term that is stable across runs.
+def termhash(term):
+    digest = hashlib.blake2b(repr(term).encode('utf-8'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'little')
+
+def splitmix(x):
+    x = x + np.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+# gaussian: returns standard normal values for an array of hashes.
+def gaussian(h):
+    u1 = 1.0 - (splitmix(h) >> np.uint64(11)) * 2.0**-53
+    u2 = (splitmix(h ^ np.uint64(0x5bd1e995)) >> np.uint64(11)) * 2.0**-53
+    return np.sqrt(-2*np.log(u1)) * np.cos(2*math.pi*u2)
+
+# simhash: returns the band keys of random hyperplane signatures.
+#   Row i of hashes is the values of the hyperplanes for term i.
+def simhash(mat, rows, hashes, nbands, nrows):
+    (indptr, indices, data) = mat
+    (j0, j1) = (indptr[rows[0]], indptr[rows[-1]+1])
+    proj = np.zeros((len(rows), nbands*nrows))
+    # rows between them that are not given must be empty.
+    ids = np.repeat(np.arange(len(rows)), indptr[rows+1]-indptr[rows])
+    np.add.at(proj, ids, data[j0:j1,None]*gaussian(hashes[indices[j0:j1]]))
+    bits = (0 < proj).reshape(len(rows), nbands, nrows).astype(np.uint64)
+    return (bits << np.arange(nrows, dtype=np.uint64)).sum(axis=2,
+                                                           dtype=np.uint64)
+
+# minhash: returns the band keys of MinHash signatures.
+def minhash(mat, rows, hashes, nbands, nrows):
+    (indptr, indices, _) = mat
+    (j0, j1) = (indptr[rows[0]], indptr[rows[-1]+1])
+    mins = np.minimum.reduceat(splitmix(hashes[indices[j0:j1]]),
+                               indptr[rows]-j0, axis=0)
+    mins = mins.reshape(len(rows), nbands, nrows)
+    keys = np.zeros((len(rows), nbands), dtype=np.uint64)
+    for i in range(nrows):
+        keys = splitmix(keys ^ mins[:,:,i])
+    return keys
+
+
+##  LSHVSM
+##  VSM that finds similar documents approximately with LSH.
+##  Documents whose signatures agree on all nrows values of any of
+##  nbands bands become candidates, and only candidates are compared
+##  with calcsim. More bands find more pairs; more rows per band find
+##  fewer but more similar ones. Buckets of more than maxbucket
+##  documents are too common to tell documents apart and are skipped.
+##
+class LSHVSM(VSM):
+
+    """
+>>> sp = LSHVSM(nbands=8, nrows=2, method='minhash')
+>>> sp.add('A', {'foo':1, 'baa':1, 'baz':2})
+>>> sp.add('B', {'foo':1, 'baa':1, 'baz':1})
+>>> sp.add('C', {'qux':1, 'baz':1})
+>>> sp.add('D', {'qux':1, 'quux':1})
+>>> sp.commit()
+>>> [ k for (_,k) in sp.findsim('A') ]
+['B']
+>>> [ (k0,k1) for (_,k0,k1) in sp.findall(threshold=0.5) ]
+[('A', 'B')]
+>>> sp = LSHVSM()
+>>> sp.add('A', {'the':1, 'cat':1})
+>>> sp.add('B', {'the':2})
+>>> sp.add('C', {'the':1, 'dog':1})
+>>> sp.commit()
+>>> list(sp.findall(threshold=0.5))
+[]
+"""
+
+    def __init__(self, nbands=16, nrows=16, method='simhash', seed=0,
+                 maxcells=1<<22, maxbucket=1000):
+        if np is None:
+            raise ImportError('LSHVSM requires numpy')
+        assert method in ('simhash', 'minhash')
+        assert method != 'simhash' or nrows <= 64
+        VSM.__init__(self)
+        self.nbands = nbands
+        self.nrows = nrows
+        self.method = method
+        self.seed = seed
+        self.maxcells = maxcells
+        self.maxbucket = maxbucket
+        self.keys = None
+        self.kids = None
+        self.sigs = None
+        self.bands = None
+        return
+
+    def add(self, key, feats):
+        VSM.add(self, key, feats)
+        self.bands = None
+        return
+
+    def remove(self, key):
+        VSM.remove(self, key)
+        self.bands = None
+        return
+
+    def commit(self):
+        if self.bands is not None: return
+        self.keys = list(self.docs.keys())
+        self.kids = { k:i for (i,k) in enumerate(self.keys) }
+        (mat, terms) = self.getmatrix()
+        nsigs = self.nbands*self.nrows
+        salt = splitmix(np.arange(nsigs, dtype=np.uint64) +
+                        np.uint64(self.seed) * np.uint64(nsigs))
+        hashes = np.array([ termhash(k) for k in terms ], dtype=np.uint64)
+        hashes = hashes.reshape(-1, 1) ^ salt
+        func = simhash if self.method == 'simhash' else minhash
+        # empty documents are not similar to anything.
+        valid = np.nonzero(np.diff(mat[0]))[0]
+        self.sigs = np.zeros((len(self.keys), self.nbands), dtype=np.uint64)
+        step = max(1, self.maxcells // nsigs // 16)
+        for i in range(0, len(valid), step):
+            rows = valid[i:i+step]
+            self.sigs[rows] = func(mat, rows, hashes, self.nbands, self.nrows)
+        self.bands = []
+        for b in range(self.nbands):
+            order = valid[np.argsort(self.sigs[valid,b], kind='stable')]
+            self.bands.append((self.sigs[order,b], order))
+        return
+
+    # getpairs: returns the candidate pairs (i,j) with i < j as i*n+j.
+    def getpairs(self):
+        n = len(self.keys)
+        pairs = [ np.zeros(0, dtype=np.int64) ]
+        for (keys, order) in self.bands:
+            edges = np.nonzero(keys[1:] != keys[:-1])[0]+1
+            starts = np.concatenate(([0], edges))
+            ends = np.concatenate((edges, [len(keys)]))
+            for (s,e) in zip(starts.tolist(), ends.tolist()):
+                if e-s < 2 or self.maxbucket < e-s: continue
+                ids = np.sort(order[s:e])
+                (i, j) = np.triu_indices(e-s, 1)
+                pairs.append(ids[i]*n + ids[j])
+        return np.unique(np.concatenate(pairs))
 
     def findsim(self, k0, threshold=0):
-        f0 = self.docs[k0]
-        a = []
-        for (k1,f1) in self.docs.items():
-            if k1 == k0: continue
-            sim = self.calcsim(f0, f1)
+        assert self.bands is not None
+        i0 = self.kids[k0]
+        cands = set()
+        for (b,(keys, order)) in enumerate(self.bands):
+            key = self.sigs[i0,b]
+            s = np.searchsorted(keys, key, 'left')
+            e = np.searchsorted(keys, key, 'right')
+            if self.maxbucket < e-s: continue
+            cands.update(order[s:e].tolist())
+        for i in sorted(cands):
+            if i == i0: continue
+            k1 = self.keys[i]
+            sim = self.docsim(k0, k1)
             if sim < threshold: continue
             yield (sim, k1)
         return
 
     def findall(self, keys=None, threshold=0, verbose=False):
+        assert self.bands is not None
+        n = len(self.keys)
+        pairs = self.getpairs()
+        (ii, jj) = (pairs // n, pairs % n)
         if keys is None:
-            items = list(self.docs.items())
+            keys = self.keys
         else:
-            items = [ (k,self.docs[k]) for k in keys ]
-        for (i,(k0,f0)) in enumerate(items):
-            for (k1,f1) in items[i+1:]:
-                sim = self.calcsim(f0, f1)
+            # renumber the pairs in the order of keys.
+            keys = list(keys)
+            pos = np.full(n, -1, dtype=np.int64)
+            pos[[ self.kids[k] for k in keys ]] = np.arange(len(keys))
+            (ii, jj) = (pos[ii], pos[jj])
+            ok = (0 <= ii) & (0 <= jj)
+            (ii, jj) = (np.minimum(ii[ok], jj[ok]), np.maximum(ii[ok], jj[ok]))
+            order = np.lexsort((jj, ii))
+            (ii, jj) = (ii[order], jj[order])
+        bounds = np.searchsorted(ii, np.arange(len(keys)+1))
+        for (i,k0) in enumerate(keys):
+            for j in jj[bounds[i]:bounds[i+1]].tolist():
+                k1 = keys[j]
+                sim = self.docsim(k0, k1)
                 if sim < threshold: continue
                 yield (sim, k0, k1)
             if verbose: